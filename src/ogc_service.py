@@ -1,20 +1,158 @@
+from collections import defaultdict
+import functools
+import http.cookiejar
+import logging
 import os
 import re
+import threading
+import time
 from urllib.parse import urljoin, urlencode, urlparse
 
-from xml.etree import ElementTree
+from xml.sax.saxutils import escape
 
-from flask import abort, Response, stream_with_context
+from flask import abort, Response
 import requests
 
 from qwc_services_core.permissions_reader import PermissionsReader
 from qwc_services_core.runtime_config import RuntimeConfig
-from qwc_services_core.auth import get_username
+from qwc_services_core.auth import get_groups, get_username
 from wfs_response_filters import wfs_describefeaturetype, \
     wfs_getcapabilities, wfs_getfeature
 from wms_response_filters import wms_getcapabilities, wms_getfeatureinfo
 
 
+# supported OWS types
+OWS_TYPES = frozenset(['WMS', 'WFS'])
+
+# prefix of external WMS layers in print requests, e.g. 'EXTERNAL_WMS:<name>'
+EXTERNAL_WMS_PREFIX = 'EXTERNAL_WMS:'
+
+# prefix of broken GML3 info formats, e.g. 'application/vnd.ogc.gml/3.1.1'
+# NOTE: plain 'application/vnd.ogc.gml' is supported
+GML_INFO_FORMAT_PREFIX = 'application/vnd.ogc.gml'
+
+# precompiled regex patterns
+# external layers, e.g. 'EXTERNAL_WMS:<name>', 'wms:<url>#<layer>' or
+# 'wfs:<url>#<layer>'
+EXTERNAL_LAYER_PATTERN = re.compile(r'^(?:EXTERNAL_WMS:|(?:wms|wfs):.+#.+$)')
+# hex color of marker params
+MARKER_COLOR_PATTERN = re.compile(r'^([A-Fa-f0-9]{6}|[A-Fa-f0-9]{3})$')
+
+
+@functools.lru_cache(maxsize=128)
+def url_netloc(url):
+    """Return network location of an URL.
+
+    :param str url: URL
+    """
+    return urlparse(url).netloc
+
+
+def compressed_format(format):
+    """Return whether an output format is already compressed.
+
+    :param str format: Output format from FORMAT param
+    """
+    # e.g. 'image/png; mode=8bit' -> 'image/png'
+    return format.split(';')[0].strip().lower() in COMPRESSED_FORMATS
+
+
+@functools.lru_cache(maxsize=256)
+def public_ogc_url_regex(url_pattern, origin):
+    """Return compiled public OGC URL pattern for an origin.
+
+    :param str url_pattern: Public OGC URL pattern with placeholder
+                            '$origin$'
+    :param str origin: The origin of the original request
+    """
+    return re.compile(
+        url_pattern.replace("$origin$", re.escape(origin.rstrip("/")))
+    )
+
+# lookup for layers params by request
+# {
+#     (<SERVICE>, <REQUEST>): (
+#         <optional layers param>, <mandatory layers param>
+#     )
+# }
+OGC_LAYERS_PARAMS = {
+    ('WMS', 'GETMAP'): ('LAYERS', None),
+    ('WMS', 'GETFEATUREINFO'): ('LAYERS', 'QUERY_LAYERS'),
+    ('WMS', 'GETLEGENDGRAPHIC'): (None, 'LAYER'),
+    ('WMS', 'GETLEGENDGRAPHICS'): (None, 'LAYER'),  # QGIS legacy request
+    ('WMS', 'DESCRIBELAYER'): (None, 'LAYERS'),
+    ('WMS', 'GETSTYLES'): (None, 'LAYERS'),
+    ('WFS', 'DESCRIBEFEATURETYPE'): ('TYPENAME', None),
+    ('WFS', 'GETFEATURE'): (None, 'TYPENAME')
+}
+
+# unfiltered requests with output format from FORMAT param
+# {(<SERVICE>, <REQUEST>)}
+FORMAT_REQUESTS = frozenset([
+    ('WMS', 'GETMAP'),
+    ('WMS', 'GETLEGENDGRAPHIC'),
+    ('WMS', 'GETLEGENDGRAPHICS'),
+    ('WMS', 'GETPRINT')
+])
+
+# already compressed output formats, which are requested from QGIS server
+# without content encoding
+# NOTE: lower case without MIME type options, GetPrint also accepts
+#       short format names
+COMPRESSED_FORMATS = frozenset([
+    'image/png', 'image/jpeg', 'image/jpg', 'image/webp', 'image/gif',
+    'application/pdf', 'png', 'jpeg', 'jpg', 'webp', 'pdf'
+])
+
+# raster export and print requests, which also permit internal print layers
+# {(<SERVICE>, <REQUEST>)}
+PRINT_LAYERS_REQUESTS = frozenset([
+    ('WMS', 'GETMAP'),
+    ('WMS', 'GETPRINT')
+])
+
+# capabilities requests filtered by permissions
+# {(<SERVICE>, <REQUEST>)}
+WMS_CAPABILITIES_REQUESTS = frozenset([
+    ('WMS', 'GETCAPABILITIES'),
+    ('WMS', 'GETPROJECTSETTINGS')
+])
+
+# GetFeatureInfo formats which are stream-parsed while filtering
+XML_INFO_FORMATS = frozenset(['text/xml', 'application/vnd.ogc.gml'])
+
+# max number of cached GetMap layer expansions per service permissions
+GETMAP_LAYERS_CACHE_SIZE = 1024
+
+# pre-encoded parts of ServiceExceptionReport XML
+SERVICE_EXCEPTION_PREFIX = (
+    b'<ServiceExceptionReport version="1.3.0">\n'
+    b' <ServiceException code="'
+)
+SERVICE_EXCEPTION_MIDDLE = b'">'
+SERVICE_EXCEPTION_SUFFIX = (
+    b'</ServiceException>\n'
+    b'</ServiceExceptionReport>'
+)
+
+
+@functools.lru_cache(maxsize=256)
+def service_exception_xml(code, message):
+    """Return encoded ServiceExceptionReport XML.
+
+    :param str code: ServiceException code
+    :param str message: ServiceException text
+    """
+    # NOTE: escape code and message, which may contain request params
+    return b''.join([
+        SERVICE_EXCEPTION_PREFIX,
+        escape(code, {'"': '&quot;'}).encode('utf-8'),
+        SERVICE_EXCEPTION_MIDDLE,
+        escape(message).encode('utf-8'),
+        SERVICE_EXCEPTION_SUFFIX
+    ])
+
+
 class OGCService:
     """OGCService class
 
@@ -22,6 +160,18 @@ class OGCService:
     Acts as a proxy to a QGIS server.
     """
 
+    # handlers for adjusting request parameters as
+    # {(<SERVICE>, <REQUEST>): <method name>}
+    ADJUST_PARAMS_HANDLERS = {
+        ('WMS', 'GETMAP'): 'adjust_getmap_params',
+        ('WMS', 'GETFEATUREINFO'): 'adjust_getfeatureinfo_params',
+        ('WMS', 'GETLEGENDGRAPHIC'): 'adjust_getlegendgraphic_params',
+        ('WMS', 'GETLEGENDGRAPHICS'): 'adjust_getlegendgraphic_params',
+        ('WMS', 'GETPRINT'): 'adjust_getprint_params',
+        ('WMS', 'DESCRIBELAYER'): 'adjust_describelayer_params',
+        ('WFS', 'GETFEATURE'): 'adjust_wfs_getfeature_params'
+    }
+
     def __init__(self, tenant, logger):
         """Constructor
 
@@ -41,10 +191,22 @@ class OGCService:
         ).rstrip('/') + '/'
         self.public_ogc_url_pattern = config.get(
             'public_ogc_url_pattern', '$origin$/.*/?$mountpoint$')
+        # public OGC URL pattern with resolved tenant and mountpoint
+        # (origin is resolved per request)
+        self.public_ogc_url_template = self.public_ogc_url_pattern\
+            .replace("$tenant$", self.tenant)\
+            .replace("$mountpoint$", re.escape(os.getenv("SERVICE_MOUNTPOINT", "").lstrip("/").rstrip("/") + "/"))
         self.basic_auth_login_url = config.get('basic_auth_login_url')
         self.qgis_server_identity_parameter = config.get("qgis_server_identity_parameter", None)
         self.legend_default_font_size = config.get("legend_default_font_size")
 
+        # authentication settings
+        self.auth_required = config.get('auth_required', False)
+        self.public_paths = frozenset(config.get('public_paths', []))
+
+        # chunk size in bytes for streamed unfiltered responses
+        self.stream_chunk_size = config.get('stream_chunk_size', 64*1024)
+
         # Marker template and param definitions
         self.marker_template = config.get('marker_template', None)
         self.marker_params = {
@@ -62,10 +224,50 @@ class OGCService:
                 logger.info("Setting marker param value %s=%s from environment" % (key.upper(), value))
             else:
                 logger.info("Setting default marker param value %s=%s" % (key.upper(), value))
+        # placeholders '$<KEY>$' of marker params in marker template
+        self.marker_template_pattern = re.compile('|'.join(
+            re.escape('$%s$' % key) for key in self.marker_params
+        ))
 
         self.resources = self.load_resources(config)
         self.permissions_handler = PermissionsReader(tenant, logger)
 
+        # HTTP session with pooled keep-alive connections to QGIS server
+        qgis_server_pool_size = config.get('qgis_server_pool_size', 64)
+        self.session = requests.Session()
+        # NOTE: do not store any upstream cookies, as the session is shared
+        #       by all users
+        self.session.cookies.set_policy(
+            http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+        )
+        # NOTE: keep one connection pool for each upstream host
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=len(self.upstream_hosts()),
+            pool_maxsize=qgis_server_pool_size
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # cache for service permissions per identity
+        # (time in seconds until expiry, 0 to disable cache)
+        self.permissions_cache_ttl = config.get('permissions_cache_ttl', 60)
+        self.permissions_cache_size = config.get(
+            'permissions_cache_size', 4096
+        )
+        self.permissions_cache = {}
+        self.permissions_cache_lock = threading.Lock()
+
+    def upstream_hosts(self):
+        """Return set of (<scheme>, <netloc>) of all QGIS server URLs."""
+        urls = [self.default_qgis_server_url]
+        for wms in self.resources['wms_services'].values():
+            urls.append(wms['wms_url'])
+            urls.append(wms['print_url'])
+        for wfs in self.resources['wfs_services'].values():
+            urls.append(wfs['wfs_url'])
+
+        return set(urlparse(url)[:2] for url in urls)
+
     def get(self, identity, service_name, host_url, params, script_root, origin):
         """Check and filter OGC GET request and forward to QGIS server.
 
@@ -107,7 +309,12 @@ class OGCService:
         :param str origin: The origin of the original request
         """
         # normalize parameter keys to upper case
-        params = {k.upper(): v for k, v in params.items()}
+        # NOTE: skip upper-casing if all keys are already upper case
+        #       (e.g. standard OGC params)
+        if all(k.isupper() for k in params.keys()):
+            params = dict(params.items())
+        else:
+            params = {k.upper(): v for k, v in params.items()}
 
         if self.qgis_server_identity_parameter is not None:
             parameter_name = self.qgis_server_identity_parameter.upper()
@@ -118,12 +325,23 @@ class OGCService:
                 params[parameter_name] = get_username(identity)
 
         # get permission
-        permission = self.service_permissions(
-            identity, service_name, params.get('SERVICE')
-        )
+        ows_type = params.get('SERVICE')
+        if ows_type in OWS_TYPES:
+            permission = self.service_permissions(
+                identity, service_name, ows_type
+            )
+        else:
+            # NOTE: skip permissions lookup and caching for missing or
+            #       unsupported OWS types (e.g. probes), which are never
+            #       permitted
+            permission = {}
+
+        # request context for values shared by checks and adjustments
+        context = {}
+        self.get_service_request(params, context)
 
         # check request
-        exception = self.check_request(params, permission)
+        exception = self.check_request(params, permission, context)
         if exception:
             return Response(
                 self.service_exception(
@@ -133,18 +351,21 @@ class OGCService:
             )
 
         # adjust request parameters
-        method = self.adjust_params(params, permission, origin, method)
+        method = self.adjust_params(
+            params, permission, origin, method, context
+        )
 
         # forward request and return filtered response
         return self.forward_request(
-            method, host_url, params, script_root, permission
+            method, host_url, params, script_root, permission, context
         )
 
-    def check_request(self, params, permission):
+    def check_request(self, params, permission, context=None):
         """Check request parameters and permissions.
 
         :param obj params: Request parameters
         :param obj permission: OGC service permission
+        :param dict context: Optional request context
         """
         exception = {}
 
@@ -161,13 +382,15 @@ class OGCService:
                 'message': "Please check the value of the REQUEST parameter"
             }
         else:
-            service = params.get('SERVICE', '')
-            request = params.get('REQUEST', '').upper()
+            service, request = self.get_service_request(params, context)
 
             if service == 'WMS' and request == 'GETFEATUREINFO':
                 # check info format
                 info_format = params.get('INFO_FORMAT', 'text/plain')
-                if re.match('^application/vnd.ogc.gml.+$', info_format):
+                if (
+                    info_format.startswith(GML_INFO_FORMAT_PREFIX)
+                    and len(info_format) > len(GML_INFO_FORMAT_PREFIX)
+                ):
                     # do not support broken GML3 info format
                     # i.e. 'application/vnd.ogc.gml/3.1.1'
                     exception = {
@@ -199,47 +422,20 @@ class OGCService:
 
         if not exception:
             # check layers params
-
-            # lookup for layers params by request
-            # {
-            #     <SERVICE>: {
-            #         <REQUEST>: [
-            #            <optional layers param>, <mandatory layers param>
-            #         ]
-            #     }
-            # }
-            ogc_layers_params = {
-                'WMS': {
-                    'GETMAP': ['LAYERS', None],
-                    'GETFEATUREINFO': ['LAYERS', 'QUERY_LAYERS'],
-                    'GETLEGENDGRAPHIC': [None, 'LAYER'],
-                    'GETLEGENDGRAPHICS': [None, 'LAYER'],  # QGIS legacy request
-                    'DESCRIBELAYER': [None, 'LAYERS'],
-                    'GETSTYLES': [None, 'LAYERS']
-                },
-                'WFS': {
-                    'DESCRIBEFEATURETYPE': ['TYPENAME', None],
-                    'GETFEATURE': [None, 'TYPENAME']
-                }
-            }
-
-            layer_params = ogc_layers_params.get(service, {}).get(request, {})
+            layer_params = OGC_LAYERS_PARAMS.get((service, request))
 
             if service == 'WMS' and request == 'GETPRINT':
-                mapname = self.get_map_param_prefix(params)
+                mapname = self.get_map_param_prefix(params, context)
 
                 if mapname and (mapname + ":LAYERS") in params:
-                    layer_params = [mapname + ":LAYERS", None]
+                    layer_params = (mapname + ":LAYERS", None)
 
             if layer_params:
-                permitted_layers = permission['public_layers'].copy()
-                filename = params.get('FILENAME', '')
-                if (service == 'WMS' and (
-                    request == 'GETMAP' or request == 'GETPRINT'
-                )):
+                permitted_layers = permission['public_layers']
+                if (service, request) in PRINT_LAYERS_REQUESTS:
                     # When doing a raster export (GetMap) or printing (GetPrint),
                     # also allow background or external layers
-                    permitted_layers += permission['internal_print_layers']
+                    permitted_layers = permission['print_permitted_layers']
                 if layer_params[0] is not None:
                     # check optional layers param
                     exception = self.check_layers(
@@ -258,24 +454,23 @@ class OGCService:
 
         :param str layer_param: Name of layers parameter
         :param obj params: Request parameters
-        :param list(str) permitted_layers: List of permitted layer names
+        :param set(str) permitted_layers: Set of permitted layer names
         :param bool mandatory: Layers parameter is mandatory
         """
         exception = None
-        wms_layer_pattern = re.compile("^wms:(.+)#(.+)$")
-        wfs_layer_pattern = re.compile("^wfs:(.+)#(.+)$")
 
         requested_layers = params.get(layer_param)
         if requested_layers:
             requested_layers = requested_layers.split(',')
+            if permitted_layers.issuperset(requested_layers):
+                # all requested layers are permitted
+                requested_layers = []
             for layer in requested_layers:
                 # allow only permitted layers
                 if (
                     layer
-                    and not wms_layer_pattern.match(layer)
-                    and not wfs_layer_pattern.match(layer)
-                    and not layer.startswith('EXTERNAL_WMS:')
                     and layer not in permitted_layers
+                    and not EXTERNAL_LAYER_PATTERN.match(layer)
                 ):
                     exception = {
                         'code': "LayerNotDefined",
@@ -303,37 +498,65 @@ class OGCService:
         :param str code: ServiceException code
         :param str message: ServiceException text
         """
-        return (
-            '<ServiceExceptionReport version="1.3.0">\n'
-            ' <ServiceException code="%s">%s</ServiceException>\n'
-            '</ServiceExceptionReport>'
-            % (code, message)
-        )
+        return service_exception_xml(code, message)
 
-    def adjust_params(self, params, permission, origin, method):
+    def adjust_params(self, params, permission, origin, method,
+                      context=None):
         """Adjust parameters depending on request and permissions.
 
         :param obj params: Request parameters
         :param obj permission: OGC service permission
         :param str origin: The origin of the original request
         :param str method: The request method
+        :param dict context: Optional request context
         """
-        ogc_service = params.get('SERVICE', '')
-        ogc_request = params.get('REQUEST', '').upper()
+        ogc_service, ogc_request = self.get_service_request(params, context)
 
         if ogc_service == 'WFS':
             # always use version 1.0.0 for WFS requests
             self.logger.warning("Overriding WFS VERSION=1.0.0")
             params['VERSION'] = '1.0.0'
 
-        if ogc_service == 'WMS' and ogc_request == 'GETMAP':
-            requested_layers = params.get('LAYERS')
-            if requested_layers:
-                # collect requested layers and opacities
-                requested_layers = requested_layers.split(',')
-                requested_layers_opacities_styles = self.padded_opacities_styles(
-                    requested_layers, params.get('OPACITIES'), params.get('STYLES')
-                )
+        handler = self.ADJUST_PARAMS_HANDLERS.get((ogc_service, ogc_request))
+        if handler is not None:
+            method = getattr(self, handler)(
+                params, permission, origin, method, context
+            )
+
+        # Return the possibly altered request method
+        return method
+
+    def adjust_getmap_params(self, params, permission, origin, method,
+                             context=None):
+        """Adjust parameters for WMS GetMap.
+
+        :param obj params: Request parameters
+        :param obj permission: OGC service permission
+        :param str origin: The origin of the original request
+        :param str method: The request method
+        :param dict context: Optional request context
+        """
+        requested_layers = params.get('LAYERS')
+        if requested_layers:
+            # NOTE: lookup expanded layers, opacities and styles for
+            #       repeated requests (e.g. map tiles)
+            cache_key = (
+                requested_layers, params.get('OPACITIES'), params.get('STYLES')
+            )
+            layers_cache = permission.get('getmap_layers_cache')
+            cached = None
+            if layers_cache is not None:
+                cached = layers_cache.get(cache_key)
+
+            # collect requested layers and opacities
+            requested_layers = requested_layers.split(',')
+
+            if cached is None:
+                requested_layers_opacities_styles = \
+                    self.padded_opacities_styles(
+                        requested_layers, params.get('OPACITIES'),
+                        params.get('STYLES')
+                    )
 
                 # replace restricted group layers with permitted sublayers
                 restricted_group_layers = permission['restricted_group_layers']
@@ -347,185 +570,253 @@ class OGCService:
                         hidden_sublayer_opacities
                     )
 
-                permitted_layers = [
-                    l['layer'] for l in permitted_layers_opacities_styles
-                ]
-                permitted_opacities = [
-                    l['opacity'] for l in permitted_layers_opacities_styles
-                ]
-                permitted_styles = [
-                    l['style'] for l in permitted_layers_opacities_styles
-                ]
-
-                params['LAYERS'] = ",".join(permitted_layers)
-                params['OPACITIES'] = ",".join(
-                    [str(o) for o in permitted_opacities]
+                # NOTE: collect layers, opacities and styles in a single pass
+                permitted_layers = []
+                permitted_opacities = []
+                permitted_styles = []
+                for l in permitted_layers_opacities_styles:
+                    permitted_layers.append(l['layer'])
+                    permitted_opacities.append(str(l['opacity']))
+                    permitted_styles.append(l['style'])
+
+                cached = (
+                    ",".join(permitted_layers),
+                    ",".join(permitted_opacities),
+                    ",".join(permitted_styles)
                 )
-                params['STYLES'] = ",".join(permitted_styles)
-
-                self.rewrite_external_wms_urls(origin, requested_layers, params)
-
-            if 'MARKER' in params and self.marker_template is not None:
-                marker_params = dict(map(lambda x: x.split("->"), params['MARKER'].split('|')))
-                if not 'X' in marker_params or not 'Y' in marker_params:
-                    abort(400, "Both X and Y need to be specified in MARKER param")
-
-                template = self.marker_template
-                param_keys = set(marker_params.keys()) | set(self.marker_params.keys())
-                for key in param_keys:
-                    # Validate
-                    value = str(marker_params.get(key, self.marker_params.get(key, {}).get("value")))
-                    paramtype = self.marker_params.get(key, {}).get("type")
-                    if paramtype == "number":
-                        try:
-                            num = float(value)
-                        except:
-                            abort(400, "Bad value for MARKER param %s (value: %s, expected to be a: %s)" % (key, value, paramtype))
-                    elif paramtype == "color":
-                        if not re.match(r"^([A-Fa-f0-9]{6}|[A-Fa-f0-9]{3})$", value):
-                            abort(400, "Bad value for MARKER param %s (value: %s, expected to be a: %s)" % (key, value, paramtype))
-                        # Prepend hash to hex value
-                        value = "#" + value
-                    elif paramtype == "string":
-                        pass
-                    else:
-                        abort(400, "Unknown parameter type %s in MARKER param %s configuration" % (paramtype, key))
-
-                    template = template.replace('$%s$' % key, value)
-                marker_geom = 'POINT (%s %s)' % (marker_params['X'], marker_params['Y'])
-
-                params['HIGHLIGHT_GEOM'] = ";".join(filter(bool, [params.get('HIGHLIGHT_GEOM', ''), marker_geom]))
-                params['HIGHLIGHT_SYMBOL'] = ";".join(filter(bool, [params.get('HIGHLIGHT_SYMBOL', ''), template]))
-                method = 'POST'
+                if layers_cache is not None:
+                    if len(layers_cache) >= GETMAP_LAYERS_CACHE_SIZE:
+                        layers_cache.clear()
+                    layers_cache[cache_key] = cached
+
+            params['LAYERS'], params['OPACITIES'], params['STYLES'] = cached
+
+            self.rewrite_external_wms_urls(origin, requested_layers, params)
+
+        if 'MARKER' in params and self.marker_template is not None:
+            marker_params = {}
+            for entry in params['MARKER'].split('|'):
+                key, sep, value = entry.partition("->")
+                if not sep:
+                    abort(400, "Bad entry in MARKER param: %s (expected: <key>-><value>)" % entry)
+                marker_params[key] = value
+            if not 'X' in marker_params or not 'Y' in marker_params:
+                abort(400, "Both X and Y need to be specified in MARKER param")
+
+            # marker param values by placeholder
+            template_values = {}
+            param_keys = set(marker_params) | set(self.marker_params)
+            for key in param_keys:
+                # Validate
+                value = str(marker_params.get(key, self.marker_params.get(key, {}).get("value")))
+                paramtype = self.marker_params.get(key, {}).get("type")
+                if paramtype == "number":
+                    try:
+                        num = float(value)
+                    except:
+                        abort(400, "Bad value for MARKER param %s (value: %s, expected to be a: %s)" % (key, value, paramtype))
+                elif paramtype == "color":
+                    if not MARKER_COLOR_PATTERN.match(value):
+                        abort(400, "Bad value for MARKER param %s (value: %s, expected to be a: %s)" % (key, value, paramtype))
+                    # Prepend hash to hex value
+                    value = "#" + value
+                elif paramtype == "string":
+                    pass
+                else:
+                    abort(400, "Unknown parameter type %s in MARKER param %s configuration" % (paramtype, key))
 
-        elif ogc_service == 'WMS' and ogc_request == 'GETFEATUREINFO':
-            requested_layers = params.get('QUERY_LAYERS')
-            if requested_layers:
-                # replace restricted group layers with permitted sublayers
-                requested_layers = requested_layers.split(',')
-                restricted_group_layers = permission['restricted_group_layers']
-                permitted_layers = self.expand_group_layers(
-                    reversed(requested_layers), restricted_group_layers
-                )
+                template_values['$%s$' % key] = value
 
-                # filter by queryable layers
-                queryable_layers = permission['queryable_layers']
-                permitted_layers = [
-                    l for l in permitted_layers if l in queryable_layers
-                ]
+            # replace all placeholders in a single pass
+            template = self.marker_template_pattern.sub(
+                lambda m: template_values[m.group(0)], self.marker_template
+            )
+            marker_geom = 'POINT (%s %s)' % (marker_params['X'], marker_params['Y'])
 
-                # reverse layer order
-                permitted_layers = reversed(permitted_layers)
+            params['HIGHLIGHT_GEOM'] = ";".join(filter(bool, [params.get('HIGHLIGHT_GEOM', ''), marker_geom]))
+            params['HIGHLIGHT_SYMBOL'] = ";".join(filter(bool, [params.get('HIGHLIGHT_SYMBOL', ''), template]))
+            method = 'POST'
 
-                params['QUERY_LAYERS'] = ",".join(permitted_layers)
+        return method
 
-        elif (ogc_service == 'WMS' and
-                ogc_request in ['GETLEGENDGRAPHIC', 'GETLEGENDGRAPHICS']):
-            requested_layers = params.get('LAYER')
-            if requested_layers:
-                # replace restricted group layers with permitted sublayers
-                requested_layers = requested_layers.split(',')
-                restricted_group_layers = permission['restricted_group_layers']
-                permitted_layers = self.expand_group_layers(
-                    requested_layers, restricted_group_layers
-                )
+    def adjust_getfeatureinfo_params(self, params, permission, origin, method,
+                                     context=None):
+        """Adjust parameters for WMS GetFeatureInfo.
 
-                params['LAYER'] = ",".join(permitted_layers)
-                # Truncate portion after mime-type which qgis server does not support for legend format
-                params['FORMAT'] = params.get('FORMAT', '').split(';')[0]
-                if self.legend_default_font_size:
-                    if 'LAYERFONTSIZE' not in params:
-                        params['LAYERFONTSIZE'] = self.legend_default_font_size
-                    if 'ITEMFONTSIZE' not in params:
-                        params['ITEMFONTSIZE'] = self.legend_default_font_size
-
-        elif ogc_service == 'WMS' and ogc_request == 'GETPRINT':
-            mapname = self.get_map_param_prefix(params)
-
-            if mapname and (mapname + ":LAYERS") in params:
-                requested_layers = params.get(mapname + ":LAYERS")
-
-            if requested_layers:
-                # collect requested layers and opacities
-                requested_layers = requested_layers.split(',')
-                requested_layers_opacities_styles = self.padded_opacities_styles(
-                    requested_layers, params.get('OPACITIES'), params.get('STYLES')
-                )
+        :param obj params: Request parameters
+        :param obj permission: OGC service permission
+        :param str origin: The origin of the original request
+        :param str method: The request method
+        :param dict context: Optional request context
+        """
+        requested_layers = params.get('QUERY_LAYERS')
+        if requested_layers:
+            # replace restricted group layers with permitted sublayers
+            requested_layers = requested_layers.split(',')
+            restricted_group_layers = permission['restricted_group_layers']
+            permitted_layers = self.expand_group_layers(
+                reversed(requested_layers), restricted_group_layers
+            )
 
-                # replace restricted group layers with permitted sublayers
-                restricted_group_layers = permission['restricted_group_layers']
-                hidden_sublayer_opacities = permission[
-                    'hidden_sublayer_opacities'
-                ]
-                permitted_layers_opacities_styles = \
-                    self.expand_group_layers_opacities_styles(
-                        requested_layers_opacities_styles, restricted_group_layers,
-                        hidden_sublayer_opacities
-                    )
+            # filter by queryable layers
+            queryable_layers = permission['queryable_layers']
+            permitted_layers = [
+                l for l in permitted_layers if l in queryable_layers
+            ]
 
-                permitted_layers = [
-                    l['layer'] for l in permitted_layers_opacities_styles
-                ]
-                permitted_opacities = [
-                    l['opacity'] for l in permitted_layers_opacities_styles
-                ]
-                permitted_styles = [
-                    l['style'] for l in permitted_layers_opacities_styles
-                ]
+            # reverse layer order
+            permitted_layers.reverse()
 
-                params[mapname + ":LAYERS"] = ",".join(permitted_layers)
-                # NOTE: also set LAYERS, so QGIS Server applies OPACITIES
-                #       correctly
-                params['LAYERS'] = params[mapname + ":LAYERS"]
-                params['OPACITIES'] = ",".join(
-                    [str(o) for o in permitted_opacities]
-                )
-                params['STYLES'] = ",".join(permitted_styles)
+            params['QUERY_LAYERS'] = ",".join(permitted_layers)
 
-                self.rewrite_external_wms_urls(origin, requested_layers, params)
+        return method
 
-        elif ogc_service == 'WMS' and ogc_request == 'DESCRIBELAYER':
-            requested_layers = params.get('LAYERS')
-            if requested_layers:
-                # replace restricted group layers with permitted sublayers
-                requested_layers = requested_layers.split(',')
-                restricted_group_layers = permission['restricted_group_layers']
-                permitted_layers = self.expand_group_layers(
-                    reversed(requested_layers), restricted_group_layers
+    def adjust_getlegendgraphic_params(self, params, permission, origin, method,
+                                       context=None):
+        """Adjust parameters for WMS GetLegendGraphic.
+
+        :param obj params: Request parameters
+        :param obj permission: OGC service permission
+        :param str origin: The origin of the original request
+        :param str method: The request method
+        :param dict context: Optional request context
+        """
+        requested_layers = params.get('LAYER')
+        if requested_layers:
+            # replace restricted group layers with permitted sublayers
+            requested_layers = requested_layers.split(',')
+            restricted_group_layers = permission['restricted_group_layers']
+            permitted_layers = self.expand_group_layers(
+                requested_layers, restricted_group_layers
+            )
+
+            params['LAYER'] = ",".join(permitted_layers)
+            # Truncate portion after mime-type which qgis server does not support for legend format
+            params['FORMAT'] = params.get('FORMAT', '').split(';')[0]
+            if self.legend_default_font_size:
+                if 'LAYERFONTSIZE' not in params:
+                    params['LAYERFONTSIZE'] = self.legend_default_font_size
+                if 'ITEMFONTSIZE' not in params:
+                    params['ITEMFONTSIZE'] = self.legend_default_font_size
+
+        return method
+
+    def adjust_getprint_params(self, params, permission, origin, method,
+                               context=None):
+        """Adjust parameters for WMS GetPrint.
+
+        :param obj params: Request parameters
+        :param obj permission: OGC service permission
+        :param str origin: The origin of the original request
+        :param str method: The request method
+        :param dict context: Optional request context
+        """
+        mapname = self.get_map_param_prefix(params, context)
+
+        if mapname and (mapname + ":LAYERS") in params:
+            requested_layers = params.get(mapname + ":LAYERS")
+
+        if requested_layers:
+            # collect requested layers and opacities
+            requested_layers = requested_layers.split(',')
+            requested_layers_opacities_styles = self.padded_opacities_styles(
+                requested_layers, params.get('OPACITIES'), params.get('STYLES')
+            )
+
+            # replace restricted group layers with permitted sublayers
+            restricted_group_layers = permission['restricted_group_layers']
+            hidden_sublayer_opacities = permission[
+                'hidden_sublayer_opacities'
+            ]
+            permitted_layers_opacities_styles = \
+                self.expand_group_layers_opacities_styles(
+                    requested_layers_opacities_styles, restricted_group_layers,
+                    hidden_sublayer_opacities
                 )
 
-                # reverse layer order
-                permitted_layers = reversed(permitted_layers)
+            # NOTE: collect layers, opacities and styles in a single pass
+            permitted_layers = []
+            permitted_opacities = []
+            permitted_styles = []
+            for l in permitted_layers_opacities_styles:
+                permitted_layers.append(l['layer'])
+                permitted_opacities.append(str(l['opacity']))
+                permitted_styles.append(l['style'])
 
-                params['LAYERS'] = ",".join(permitted_layers)
+            params[mapname + ":LAYERS"] = ",".join(permitted_layers)
+            # NOTE: also set LAYERS, so QGIS Server applies OPACITIES
+            #       correctly
+            params['LAYERS'] = params[mapname + ":LAYERS"]
+            params['OPACITIES'] = ",".join(permitted_opacities)
+            params['STYLES'] = ",".join(permitted_styles)
 
-        elif ogc_service == 'WFS' and ogc_request == 'GETFEATURE':
-            requested_layers = params.get('TYPENAME')
-            if requested_layers:
-                requested_layers = requested_layers.split(',')
-                if len(requested_layers) == 1:
-                    # single layer requested
-                    # get permitted attributes for layer
-                    permitted_attributes = permission['layers'].get(
-                        requested_layers[0], {}
-                    )
+            self.rewrite_external_wms_urls(origin, requested_layers, params)
 
-                    propertyname = params.get('PROPERTYNAME')
-                    if propertyname:
-                        # filter requested attributes
-                        requested_attributes = propertyname.split(',')
-                        attributes = [
-                            attr for attr in requested_attributes
-                            if attr in permitted_attributes
-                        ]
-                        params['PROPERTYNAME'] = ",".join(attributes)
-                    else:
-                        # add PROPERTYNAME to filter attributes in WFS server
-                        params['PROPERTYNAME'] = ",".join(permitted_attributes)
+        return method
+
+    def adjust_describelayer_params(self, params, permission, origin, method,
+                                    context=None):
+        """Adjust parameters for WMS DescribeLayer.
+
+        :param obj params: Request parameters
+        :param obj permission: OGC service permission
+        :param str origin: The origin of the original request
+        :param str method: The request method
+        :param dict context: Optional request context
+        """
+        requested_layers = params.get('LAYERS')
+        if requested_layers:
+            # replace restricted group layers with permitted sublayers
+            requested_layers = requested_layers.split(',')
+            restricted_group_layers = permission['restricted_group_layers']
+            permitted_layers = self.expand_group_layers(
+                reversed(requested_layers), restricted_group_layers
+            )
+
+            # reverse layer order
+            permitted_layers.reverse()
+
+            params['LAYERS'] = ",".join(permitted_layers)
 
-        # Return the possibly altered request method
         return method
 
+    def adjust_wfs_getfeature_params(self, params, permission, origin, method,
+                                     context=None):
+        """Adjust parameters for WFS GetFeature.
+
+        :param obj params: Request parameters
+        :param obj permission: OGC service permission
+        :param str origin: The origin of the original request
+        :param str method: The request method
+        :param dict context: Optional request context
+        """
+        requested_layers = params.get('TYPENAME')
+        if requested_layers:
+            requested_layers = requested_layers.split(',')
+            if len(requested_layers) == 1:
+                # single layer requested
+                # get permitted attributes for layer
+                permitted_attributes = permission['layers'].get(
+                    requested_layers[0], {}
+                )
+
+                propertyname = params.get('PROPERTYNAME')
+                if propertyname:
+                    # filter requested attributes
+                    permitted_attributes = permission[
+                        'layer_attributes'
+                    ].get(requested_layers[0], frozenset())
+                    requested_attributes = propertyname.split(',')
+                    attributes = [
+                        attr for attr in requested_attributes
+                        if attr in permitted_attributes
+                    ]
+                    params['PROPERTYNAME'] = ",".join(attributes)
+                else:
+                    # add PROPERTYNAME to filter attributes in WFS server
+                    params['PROPERTYNAME'] = ",".join(permitted_attributes)
+
+        return method
 
     def rewrite_external_wms_urls(self, origin, layersparam, params):
         # Rewrite URLs of EXTERNAL_WMS which point to the ogc service:
@@ -537,18 +828,20 @@ class OGCService:
         #   hence it won't be able to load any restricted layers over the ogc service
         if not origin:
             return
-        pattern = self.public_ogc_url_pattern\
-            .replace("$origin$", re.escape(origin.rstrip("/")))\
-            .replace("$tenant$", self.tenant)\
-            .replace("$mountpoint$", re.escape(os.getenv("SERVICE_MOUNTPOINT", "").lstrip("/").rstrip("/") + "/"))
+        pattern = None
         for layer in layersparam:
-            if not layer.startswith("EXTERNAL_WMS:"):
+            if not layer.startswith(EXTERNAL_WMS_PREFIX):
                 continue
-            urlparam = layer[13:] + ":URL"
-            if not urlparam in params:
+            urlparam = layer[len(EXTERNAL_WMS_PREFIX):] + ":URL"
+            url = params.get(urlparam)
+            if url is None:
                 continue
-            params[urlparam] = re.sub(
-                pattern, self.default_qgis_server_url, params[urlparam])
+            if pattern is None:
+                # NOTE: compile pattern only once per origin
+                pattern = public_ogc_url_regex(
+                    self.public_ogc_url_template, origin
+                )
+            params[urlparam] = pattern.sub(self.default_qgis_server_url, url)
 
     def padded_opacities_styles(self, requested_layers, opacities_param, styles_param):
         """Complement requested opacities and styles to match number of requested layers.
@@ -596,22 +889,30 @@ class OGCService:
         return requested_layers_opacities_styles
 
     def expand_group_layers(self, requested_layers, restricted_group_layers):
-        """Recursively replace group layers with permitted sublayers and
-        return resulting layer list.
+        """Replace group layers and nested group layers with permitted
+        sublayers and return resulting layer list.
 
         :param list(str) requested_layers: List of requested layer names
         :param obj restricted_group_layers: Lookup for group layers with
                                             restricted sublayers
         """
+        if not restricted_group_layers:
+            # no group layers to expand
+            return list(requested_layers)
+
         permitted_layers = []
 
-        for layer in requested_layers:
-            if layer in restricted_group_layers.keys():
+        # NOTE: expand nested groups with an explicit stack instead of
+        #       recursion, with next layer to process at the end
+        stack = list(requested_layers)
+        stack.reverse()
+        while stack:
+            layer = stack.pop()
+            sublayers = restricted_group_layers.get(layer)
+            if sublayers is not None:
                 # expand sublayers and reorder from bottom to top
-                sublayers = reversed(restricted_group_layers.get(layer))
-                permitted_layers += self.expand_group_layers(
-                    sublayers, restricted_group_layers
-                )
+                # (i.e. push in original order, last sublayer is popped first)
+                stack.extend(sublayers)
             else:
                 # leaf layer or permitted group layer
                 permitted_layers.append(layer)
@@ -621,8 +922,8 @@ class OGCService:
     def expand_group_layers_opacities_styles(self, requested_layers_opacities_styles,
                                           restricted_group_layers,
                                           hidden_sublayer_opacities):
-        """Recursively replace group layers and opacities with permitted
-        sublayers and return resulting layers and opacities list.
+        """Replace group layers and opacities with permitted sublayers and
+        return resulting layers and opacities list.
 
         :param list(obj) requested_layers_opacities_styles: List of requested
             layer names and opacities as
@@ -640,16 +941,21 @@ class OGCService:
         """
         permitted_layers_opacities = []
 
-        for lo in requested_layers_opacities_styles:
-            layer = lo['layer']
-            opacity = lo['opacity']
-
-            if layer in restricted_group_layers.keys():
-                # expand sublayers ordered from bottom to top,
-                # use opacity from group
-                sublayers = reversed(restricted_group_layers.get(layer))
-                sublayers_opacities_styles = []
-
+        # NOTE: expand nested groups with an explicit stack of
+        #       (<layer>, <opacity>, <style>) instead of recursion,
+        #       with next layer to process at the end
+        stack = [
+            (lo['layer'], lo['opacity'], lo['style'])
+            for lo in reversed(requested_layers_opacities_styles)
+        ]
+        while stack:
+            layer, opacity, style = stack.pop()
+
+            sublayers = restricted_group_layers.get(layer)
+            if sublayers is not None:
+                # expand sublayers ordered from bottom to top
+                # (i.e. push in original order, last sublayer is popped
+                # first), use opacity from group
                 for sublayer in sublayers:
                     sub_opacity = opacity
                     if sublayer in hidden_sublayer_opacities:
@@ -661,28 +967,19 @@ class OGCService:
                             opacity * custom_opacity / 100
                         )
 
-                    sublayers_opacities_styles.append({
-                        'layer': sublayer,
-                        'opacity': sub_opacity,
-                        'style': ''
-                    })
-                permitted_layers_opacities += \
-                    self.expand_group_layers_opacities_styles(
-                        sublayers_opacities_styles, restricted_group_layers,
-                        hidden_sublayer_opacities
-                    )
+                    stack.append((sublayer, sub_opacity, ''))
             else:
                 # leaf layer or permitted group layer
                 permitted_layers_opacities.append({
                     'layer': layer,
                     'opacity': opacity,
-                    'style': lo['style']
+                    'style': style
                 })
 
         return permitted_layers_opacities
 
     def forward_request(self, method, host_url, params, script_root,
-                        permission):
+                        permission, context=None):
         """Forward request to QGIS server and return filtered response.
 
         :param str method: Request method 'GET' or 'POST'
@@ -690,16 +987,17 @@ class OGCService:
         :param obj params: Request parameters
         :param str script_root: Request root path
         :param obj permission: OGC service permission
+        :param dict context: Optional request context
         """
-        ogc_service = params.get('SERVICE', '')
-        ogc_request = params.get('REQUEST', '').upper()
+        ogc_service, ogc_request = self.get_service_request(params, context)
 
         stream = True
-        if ogc_request in [
-            'GETCAPABILITIES', 'GETPROJECTSETTINGS', 'GETFEATUREINFO',
-            'DESCRIBEFEATURETYPE'
-        ]:
-            # do not stream if response is filtered
+        if (
+            ogc_request == 'GETFEATUREINFO' and
+            params.get('INFO_FORMAT', 'text/plain') not in XML_INFO_FORMATS
+        ):
+            # do not stream if response is filtered as text
+            # NOTE: XML responses are stream-parsed while filtering
             stream = False
 
         # forward to QGIS server
@@ -712,22 +1010,41 @@ class OGCService:
             # raster export (GetMap with FILENAME) or printing
             url = permission['print_url']
 
+        # NOTE: skip formatting of log messages if not logged
+        log_info = self.logger.isEnabledFor(logging.INFO)
+
+        headers = {'host': url_netloc(host_url)}
+        if (
+            (ogc_service, ogc_request) in FORMAT_REQUESTS and
+            compressed_format(params.get('FORMAT', ''))
+        ):
+            # NOTE: do not let QGIS server compress already compressed
+            #       images or PDFs, which are passed through unfiltered
+            headers['accept-encoding'] = 'identity'
+
         if method == 'POST':
-            # log forward URL and params
-            self.logger.info("Forward POST request to %s" % url)
-            self.logger.info("  %s" % ("\n  ").join(
-                ("%s = %s" % (k, v) for k, v, in params.items()))
-            )
+            if log_info:
+                # log forward URL and params
+                self.logger.info("Forward POST request to %s", url)
+                self.logger.info("  %s", ("\n  ").join(
+                    ("%s = %s" % (k, v) for k, v, in params.items()))
+                )
 
-            response = requests.post(url, headers={'host': urlparse(host_url).netloc},
-                                     data=params, stream=stream)
+            response = self.session.post(
+                url, headers=headers,
+                data=params, stream=stream
+            )
         else:
-            # log forward URL and params
-            self.logger.info("Forward GET request to %s?%s" %
-                             (url, urlencode(params)))
+            if log_info:
+                # log forward URL and params
+                self.logger.info(
+                    "Forward GET request to %s?%s", url, urlencode(params)
+                )
 
-            response = requests.get(url, headers={'host': urlparse(host_url).netloc},
-                                    params=params, stream=stream)
+            response = self.session.get(
+                url, headers=headers,
+                params=params, stream=stream
+            )
 
         if response.status_code != requests.codes.ok:
             # handle internal server error
@@ -746,9 +1063,7 @@ class OGCService:
                 status=response.status_code
             )
         # return filtered response
-        elif ogc_service == 'WMS' and ogc_request in [
-            'GETCAPABILITIES', 'GETPROJECTSETTINGS'
-        ]:
+        elif (ogc_service, ogc_request) in WMS_CAPABILITIES_REQUESTS:
             return wms_getcapabilities(
                 response, host_url, params, script_root, permission
             )
@@ -765,8 +1080,21 @@ class OGCService:
             return wfs_getfeature(response, params, permission)
         else:
             # unfiltered streamed response
+            headers = {}
+            if (
+                'content-length' in response.headers and
+                'content-encoding' not in response.headers
+            ):
+                # forward length of unencoded content
+                headers['content-length'] = response.headers['content-length']
+
+            # NOTE: stream directly from raw response, as chunks do not
+            #       need the request context
             return Response(
-                stream_with_context(response.iter_content(chunk_size=16*1024)),
+                response.raw.stream(
+                    self.stream_chunk_size, decode_content=True
+                ),
+                headers=headers,
                 content_type=response.headers['content-type'],
                 status=response.status_code
             )
@@ -827,6 +1155,22 @@ class OGCService:
             # collect WMS layers
             self.collect_layers(wms['root_layer'], resources, False)
 
+            # available layers: {<layers>}
+            resources['available_layers'] = frozenset().union(
+                resources['layers'], resources['group_layers'],
+                resources['internal_print_layers']
+            )
+            # available attribute sets for lookups: {<layer>: {<attrs>}}
+            resources['layer_attribute_sets'] = {
+                layer: frozenset(attrs)
+                for layer, attrs in resources['layers'].items()
+            }
+            # feature info aliases by layer: {<layer>: [<feature info layers>]}
+            aliases_by_layer = defaultdict(list)
+            for alias, layer in resources['feature_info_aliases'].items():
+                aliases_by_layer[layer].append(alias)
+            resources['feature_info_aliases_by_layer'] = dict(aliases_by_layer)
+
             wms_services[wms['name']] = resources
 
         # collect WFS service resources
@@ -847,7 +1191,13 @@ class OGCService:
                 # custom online resource
                 'online_resource': wfs.get('online_resource'),
                 # layers with available attributes: {<layer>: [<attrs>]}
-                'layers': layers
+                'layers': layers,
+                # available layers: {<layers>}
+                'available_layers': frozenset(layers),
+                # available attribute sets for lookups: {<layer>: {<attrs>}}
+                'layer_attribute_sets': {
+                    layer: frozenset(attrs) for layer, attrs in layers.items()
+                }
             }
 
             wfs_services[wfs['name']] = resources
@@ -858,52 +1208,178 @@ class OGCService:
         }
 
     def collect_layers(self, layer, resources, hidden):
-        """Recursively collect layer info for layer subtree from config.
+        """Collect layer info for layer subtree from config.
 
         :param obj layer: Layer or group layer
         :param obj resources: Partial lookups for layer resources
         :param bool hidden: Whether layer is a hidden sublayer
         """
-        if not hidden:
-            resources['public_layers'].append(layer['name'])
-
-        if layer.get('layers'):
-            # group layer
-
-            hidden |= layer.get('hide_sublayers', False)
-
-            # collect sub layers
-            queryable = False
-            sublayers = []
-            for sublayer in layer['layers']:
-                sublayers.append(sublayer['name'])
-                # recursively collect sub layer
-                self.collect_layers(sublayer, resources, hidden)
-                if sublayer['name'] in resources['queryable_layers']:
+        # lookup for queryable layers
+        queryable_layers = set(resources['queryable_layers'])
+
+        # NOTE: traverse layer tree with an explicit stack instead of
+        #       recursion, with next step to process at the end, as
+        #       (<step>, <layer>, <hidden or group state>)
+        stack = [('layer', layer, hidden)]
+        while stack:
+            step, layer, value = stack.pop()
+
+            if step == 'sublayer':
+                # sub layer collected
+                if layer['name'] in queryable_layers:
                     # group is queryable if any sub layer is queryable
-                    queryable = True
+                    value['queryable'] = True
+                continue
+            elif step == 'group':
+                # all sub layers of group collected
+                resources['group_layers'][layer['name']] = value['sublayers']
+                if value['queryable']:
+                    resources['queryable_layers'].append(layer['name'])
+                    queryable_layers.add(layer['name'])
+                continue
 
-            resources['group_layers'][layer['name']] = sublayers
-            if queryable:
-                resources['queryable_layers'].append(layer['name'])
-        else:
-            # layer
+            hidden = value
+            if not hidden:
+                resources['public_layers'].append(layer['name'])
 
-            # attributes
-            resources['layers'][layer['name']] = layer.get('attributes', [])
+            if layer.get('layers'):
+                # group layer
 
-            if hidden and layer.get('opacity'):
-                # add custom opacity for hidden sublayer
-                resources['hidden_sublayer_opacities'][layer['name']] = \
-                    layer.get('opacity')
+                hidden |= layer.get('hide_sublayers', False)
 
-            if layer.get('queryable', False) is True:
-                resources['queryable_layers'].append(layer['name'])
-                layer_title = layer.get('title', layer['name'])
-                resources['feature_info_aliases'][layer_title] = layer['name']
+                # collect sub layers
+                group = {
+                    'queryable': False,
+                    'sublayers': [
+                        sublayer['name'] for sublayer in layer['layers']
+                    ]
+                }
+                stack.append(('group', layer, group))
+                for sublayer in reversed(layer['layers']):
+                    stack.append(('sublayer', sublayer, group))
+                    stack.append(('layer', sublayer, hidden))
+            else:
+                # layer
+
+                # attributes
+                resources['layers'][layer['name']] = layer.get(
+                    'attributes', []
+                )
+
+                if hidden and layer.get('opacity'):
+                    # add custom opacity for hidden sublayer
+                    resources['hidden_sublayer_opacities'][layer['name']] = \
+                        layer.get('opacity')
+
+                if layer.get('queryable', False) is True:
+                    resources['queryable_layers'].append(layer['name'])
+                    queryable_layers.add(layer['name'])
+                    layer_title = layer.get('title', layer['name'])
+                    resources['feature_info_aliases'][layer_title] = \
+                        layer['name']
 
     def service_permissions(self, identity, service_name, ows_type):
-        """Return permissions for a OGC service.
+        """Return cached permissions for a OGC service.
+
+        NOTE: cached permissions are shared between requests and must not
+              be modified (except for the GetMap layers cache)
+
+        NOTE: the cache is discarded together with this OGCService instance
+              on any config or permissions update, so the TTL and max size
+              only limit the memory used by the cache
+
+        :param str identity: User identity
+        :param str service_name: OGC service name
+        :param str ows_type: OWS type (WMS or WFS)
+        """
+        if self.permissions_cache_ttl <= 0:
+            # cache disabled
+            return self.collect_service_permissions(
+                identity, service_name, ows_type
+            )
+
+        cache_key = self.identity_cache_key(identity) + (
+            service_name, ows_type
+        )
+
+        now = time.monotonic()
+        with self.permissions_cache_lock:
+            entry = self.permissions_cache.get(cache_key)
+        if entry is not None and entry['expires'] > now:
+            return entry['permissions']
+
+        permissions = self.collect_service_permissions(
+            identity, service_name, ows_type
+        )
+
+        with self.permissions_cache_lock:
+            if len(self.permissions_cache) >= self.permissions_cache_size:
+                # remove expired entries
+                self.permissions_cache = {
+                    key: entry
+                    for key, entry in self.permissions_cache.items()
+                    if entry['expires'] > now
+                }
+            while len(self.permissions_cache) >= self.permissions_cache_size:
+                # remove oldest entry
+                del self.permissions_cache[next(iter(self.permissions_cache))]
+
+            self.permissions_cache[cache_key] = {
+                'permissions': permissions,
+                'expires': now + self.permissions_cache_ttl
+            }
+
+        return permissions
+
+    def identity_cache_key(self, identity):
+        """Return cache key for identity.
+
+        NOTE: permissions depend only on username and groups of identity
+
+        :param obj identity: User identity
+        """
+        return (get_username(identity), tuple(sorted(set(get_groups(identity)))))
+
+    def merge_permitted_layers(self, resources, permissions):
+        """Combine permitted layers and attributes of all permissions
+        of a WMS or WFS.
+
+        Return permitted layers with permitted attributes as
+        {<layer>: frozenset(<attrs>)}.
+
+        :param obj resources: WMS or WFS resources
+        :param list(obj) permissions: WMS or WFS permissions
+        """
+        available_layers = resources['available_layers']
+        layer_attribute_sets = resources['layer_attribute_sets']
+
+        permitted_layers = defaultdict(set)
+        for permission in permissions:
+            # collect available and permitted layers
+            for layer in permission['layers']:
+                name = layer['name']
+                if name not in available_layers:
+                    continue
+
+                # add permitted layer with any available and permitted
+                # attributes
+                permitted_attributes = permitted_layers[name]
+                attributes = layer.get('attributes')
+                if attributes:
+                    available_attributes = layer_attribute_sets[name]
+                    permitted_attributes.update(
+                        attr for attr in attributes
+                        if attr in available_attributes
+                    )
+
+        # freeze permitted attributes after combining permissions
+        return {
+            name: frozenset(attrs)
+            for name, attrs in permitted_layers.items()
+        }
+
+    def collect_service_permissions(self, identity, service_name, ows_type):
+        """Collect permissions for a OGC service.
 
         :param str identity: User identity
         :param str service_name: OGC service name
@@ -924,36 +1400,17 @@ class OGCService:
                 # WMS not permitted
                 return {}
 
-            wms_resources = self.resources['wms_services'][service_name].copy()
+            # NOTE: resources are only read, no copy required
+            wms_resources = self.resources['wms_services'][service_name]
 
-            # get available layers
-            available_layers = set(
-                list(wms_resources['layers'].keys()) +
-                list(wms_resources['group_layers'].keys()) +
-                wms_resources['internal_print_layers']
+            # combine permissions
+            # permitted layers with permitted attributes: {<layer>: {<attrs>}}
+            permitted_layers = self.merge_permitted_layers(
+                wms_resources, wms_permissions
             )
 
-            # combine permissions
-            # permitted layers with permitted attributes: {<layer>: [<attrs>]}
-            permitted_layers = {}
             permitted_print_templates = set()
             for permission in wms_permissions:
-                # collect available and permitted layers
-                for layer in permission['layers']:
-                    name = layer['name']
-                    if name in available_layers:
-                        if name not in permitted_layers:
-                            # add permitted layer
-                            permitted_layers[name] = set()
-
-                        # collect available and permitted attributes
-                        attributes = [
-                            attr for attr in layer.get('attributes', [])
-                            if attr in wms_resources['layers'][name]
-                        ]
-                        # add any attributes
-                        permitted_layers[name].update(attributes)
-
                 # collect available and permitted print templates
                 print_templates = [
                     template for template in permission.get('print_templates', [])
@@ -961,58 +1418,82 @@ class OGCService:
                 ]
                 permitted_print_templates.update(print_templates)
 
-            # filter by permissions
+            print_templates = frozenset(
+                template for template in wms_resources['print_templates']
+                if template in permitted_print_templates
+            )
 
-            public_layers = [
-                layer for layer in wms_resources['public_layers']
-                if layer in permitted_layers
-            ]
+            # filter by permissions
+            # NOTE: use sets for layer lookups
+            if not permitted_layers:
+                # NOTE: skip filters if no layers are permitted
+                public_layers = frozenset()
+                layers = {}
+                layer_attributes = {}
+                queryable_layers = frozenset()
+                feature_info_aliases = {}
+                restricted_group_layers = {}
+                hidden_sublayer_opacities = {}
+                internal_print_layers = frozenset()
+            else:
+                public_layers = frozenset(
+                    layer for layer in wms_resources['public_layers']
+                    if layer in permitted_layers
+                )
 
-            # layer attributes
-            layers = {}
-            for layer, attrs in wms_resources['layers'].items():
-                if layer in permitted_layers:
-                    # filter attributes by permissions
-                    layers[layer] = [
-                        attr for attr in attrs
-                        if attr in permitted_layers[layer]
+                # layer attributes filtered by permissions
+                layers = {
+                    layer: [
+                        attr for attr in attrs if attr in permitted_layers[layer]
                     ]
+                    for layer, attrs in wms_resources['layers'].items()
+                    if layer in permitted_layers
+                }
 
-            queryable_layers = [
-                layer for layer in wms_resources['queryable_layers']
-                if layer in permitted_layers
-            ]
+                # permitted attribute sets for lookups
+                # NOTE: permitted attributes are already limited to available
+                #       attributes
+                layer_attributes = {
+                    layer: permitted_layers[layer] for layer in layers
+                }
 
-            feature_info_aliases = {}
-            for alias, layer in wms_resources['feature_info_aliases'].items():
-                if layer in permitted_layers:
-                    feature_info_aliases[alias] = layer
-
-            # restricted group layers
-            restricted_group_layers = {}
-            # NOTE: always expand all group layers
-            for group, sublayers in wms_resources['group_layers'].items():
-                if group in permitted_layers:
-                    # filter sublayers by permissions
-                    restricted_group_layers[group] = [
-                        layer for layer in sublayers
-                        if layer in permitted_layers
+                queryable_layers = frozenset(
+                    layer for layer in wms_resources['queryable_layers']
+                    if layer in permitted_layers
+                )
+
+                # NOTE: lookup aliases only for permitted layers
+                aliases_by_layer = wms_resources['feature_info_aliases_by_layer']
+                feature_info_aliases = {
+                    alias: layer
+                    for layer in permitted_layers
+                    for alias in aliases_by_layer.get(layer, [])
+                }
+
+                # restricted group layers with sublayers filtered by permissions
+                # NOTE: always expand all group layers
+                restricted_group_layers = {
+                    group: [
+                        layer for layer in sublayers if layer in permitted_layers
                     ]
+                    for group, sublayers in wms_resources['group_layers'].items()
+                    if group in permitted_layers
+                }
 
-            hidden_sublayer_opacities = {}
-            for layer, opacity in wms_resources['hidden_sublayer_opacities'].items():
-                if layer in permitted_layers:
-                    hidden_sublayer_opacities[layer] = opacity
+                hidden_sublayer_opacities = {
+                    layer: opacity
+                    for layer, opacity
+                    in wms_resources['hidden_sublayer_opacities'].items()
+                    if layer in permitted_layers
+                }
 
-            internal_print_layers = [
-                layer for layer in wms_resources['internal_print_layers']
-                if layer in permitted_layers
-            ]
+                internal_print_layers = frozenset(
+                    layer for layer in wms_resources['internal_print_layers']
+                    if layer in permitted_layers
+                )
 
-            print_templates = [
-                template for template in wms_resources['print_templates']
-                if template in permitted_print_templates
-            ]
+            # public and internal print layers for GetMap and GetPrint
+            print_permitted_layers = public_layers | internal_print_layers
 
             return {
                 'service_name': service_name,
@@ -1022,11 +1503,13 @@ class OGCService:
                 'print_url': wms_resources['print_url'],
                 # custom online resource
                 'online_resources': wms_resources['online_resources'],
-                # public layers without hidden sublayers
+                # public layers without hidden sublayers: {<layers>}
                 'public_layers': public_layers,
                 # layers with permitted attributes
                 'layers': layers,
-                # queryable layers
+                # permitted attributes per layer: {<layer>: {<attrs>}}
+                'layer_attributes': layer_attributes,
+                # queryable layers: {<layers>}
                 'queryable_layers': queryable_layers,
                 # layer aliases for feature info results
                 'feature_info_aliases': feature_info_aliases,
@@ -1036,10 +1519,16 @@ class OGCService:
                 'restricted_group_layers': restricted_group_layers,
                 # custom opacities for hidden sublayers
                 'hidden_sublayer_opacities': hidden_sublayer_opacities,
-                # internal layers for printing
+                # internal layers for printing: {<layers>}
                 'internal_print_layers': internal_print_layers,
-                # print templates
-                'print_templates': print_templates
+                # public and internal print layers: {<layers>}
+                'print_permitted_layers': print_permitted_layers,
+                # print templates: {<template names>}
+                'print_templates': print_templates,
+                # expanded GetMap layers, opacities and styles as
+                #     {(<LAYERS>, <OPACITIES>, <STYLES>):
+                #         (<LAYERS>, <OPACITIES>, <STYLES>)}
+                'getmap_layers_cache': {}
             }
         elif ows_type == 'WFS':
             if not self.resources['wfs_services'].get(service_name):
@@ -1054,47 +1543,42 @@ class OGCService:
                 # WFS not permitted
                 return {}
 
-            wfs_resources = self.resources['wfs_services'][service_name].copy()
-
-            # get available layers
-            available_layers = set(list(wfs_resources['layers'].keys()))
+            # NOTE: resources are only read, no copy required
+            wfs_resources = self.resources['wfs_services'][service_name]
 
             # combine permissions
-            # permitted layers with permitted attributes: {<layer>: [<attrs>]}
-            permitted_layers = {}
-            for permission in wfs_permissions:
-                # collect available and permitted layers
-                for layer in permission['layers']:
-                    name = layer['name']
-                    if name in available_layers:
-                        if name not in permitted_layers:
-                            # add permitted layer
-                            permitted_layers[name] = set()
-
-                        # collect available and permitted attributes
-                        attributes = [
-                            attr for attr in layer.get('attributes', [])
-                            if attr in wfs_resources['layers'][name]
-                        ]
-                        # add any attributes
-                        permitted_layers[name].update(attributes)
+            # permitted layers with permitted attributes: {<layer>: {<attrs>}}
+            permitted_layers = self.merge_permitted_layers(
+                wfs_resources, wfs_permissions
+            )
 
             # filter by permissions
+            if not permitted_layers:
+                # NOTE: skip filters if no layers are permitted
+                public_layers = frozenset()
+                layers = {}
+                layer_attributes = {}
+            else:
+                public_layers = frozenset(
+                    layer for layer in wfs_resources['layers']
+                    if layer in permitted_layers
+                )
 
-            public_layers = [
-                layer for layer in wfs_resources['layers']
-                if layer in permitted_layers
-            ]
-
-            # layer attributes
-            layers = {}
-            for layer, attrs in wfs_resources['layers'].items():
-                if layer in permitted_layers:
-                    # filter attributes by permissions
-                    layers[layer] = [
-                        attr for attr in attrs
-                        if attr in permitted_layers[layer]
+                # layer attributes filtered by permissions
+                layers = {
+                    layer: [
+                        attr for attr in attrs if attr in permitted_layers[layer]
                     ]
+                    for layer, attrs in wfs_resources['layers'].items()
+                    if layer in permitted_layers
+                }
+
+                # permitted attribute sets for lookups
+                # NOTE: permitted attributes are already limited to available
+                #       attributes
+                layer_attributes = {
+                    layer: permitted_layers[layer] for layer in layers
+                }
 
             return {
                 'service_name': service_name,
@@ -1102,20 +1586,50 @@ class OGCService:
                 'ogc_url': wfs_resources['wfs_url'],
                 # custom online resource
                 'online_resource': wfs_resources['online_resource'],
-                # public layers
+                # public layers: {<layers>}
                 'public_layers': public_layers,
                 # layers with permitted attributes
-                'layers': layers
+                'layers': layers,
+                # permitted attributes per layer: {<layer>: {<attrs>}}
+                'layer_attributes': layer_attributes
             }
 
         # unsupported OWS type
         return {}
 
-    def get_map_param_prefix(self, params):
+    def get_service_request(self, params, context=None):
+        """Return OGC service and upper case request name.
+
+        :param obj params: Request parameters
+        :param dict context: Optional request context
+        """
+        if context is not None and 'service_request' in context:
+            # use service and request from request context
+            return context['service_request']
+
+        service_request = (
+            params.get('SERVICE', ''), params.get('REQUEST', '').upper()
+        )
+
+        if context is not None:
+            # store service and request in request context
+            context['service_request'] = service_request
+
+        return service_request
+
+    def get_map_param_prefix(self, params, context=None):
+        if context is not None and 'mapname' in context:
+            # use map name from request context
+            return context['mapname']
+
         # Deduce map name by looking for param which ends with :EXTENT
         # (Can't look for param ending with :LAYERS as there might be i.e. A:LAYERS for the external layer definition A)
-        mapname = ""
-        for key, value in params.items():
-            if key.endswith(":EXTENT"):
-                return key[0:-7]
-        return ""
+        mapname = next(
+            (key[:-7] for key in params if key.endswith(":EXTENT")), ""
+        )
+
+        if context is not None:
+            # store map name in request context
+            context['mapname'] = mapname
+
+        return mapname
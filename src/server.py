@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, json, redirect
+from flask import Flask, request, jsonify, json, redirect, g
 from flask_restx import Api, Resource
 import urllib.parse
 import requests
@@ -7,7 +7,6 @@ import os
 
 from qwc_services_core.auth import auth_manager, optional_auth, get_identity  # noqa: E402
 from qwc_services_core.tenant_handler import TenantHandler, TenantPrefixMiddleware, TenantSessionInterface
-from qwc_services_core.runtime_config import RuntimeConfig
 from ogc_service import OGCService
 
 
@@ -38,13 +37,32 @@ app.wsgi_app = TenantPrefixMiddleware(app.wsgi_app)
 app.session_interface = TenantSessionInterface(os.environ)
 
 
+def ogc_tenant():
+    """Get tenant of current request.
+
+    NOTE: cached in request context, as this is called multiple times
+          per request
+    """
+    if 'ogc_tenant' not in g:
+        g.ogc_tenant = tenant_handler.tenant()
+    return g.ogc_tenant
+
+
 def ogc_service_handler():
-    """Get or create a OGCService instance for a tenant."""
-    tenant = tenant_handler.tenant()
+    """Get or create a OGCService instance for a tenant.
+
+    NOTE: cached in request context, as this is called both before the
+          request and in the request handler
+    """
+    if 'ogc_handler' in g:
+        return g.ogc_handler
+
+    tenant = ogc_tenant()
     handler = tenant_handler.handler('ogc', 'ogc', tenant)
     if handler is None:
         handler = tenant_handler.register_handler(
             'ogc', tenant, OGCService(tenant, app.logger))
+    g.ogc_handler = handler
     return handler
 
 
@@ -57,7 +75,7 @@ def get_identity_or_auth(ogc_service):
             headers = {}
             if tenant_handler.tenant_header:
                 # forward tenant header
-                headers[tenant_handler.tenant_header] = tenant_handler.tenant()
+                headers[tenant_handler.tenant_header] = ogc_tenant()
             for login_url in ogc_service.basic_auth_login_url:
                 app.logger.debug(f"Checking basic auth via {login_url}")
                 data = {'username': auth.username, 'password': auth.password}
@@ -83,15 +101,13 @@ def assert_user_is_logged():
     if request.endpoint in public_endpoints:
         return
 
-    tenant = tenant_handler.tenant()
-    config_handler = RuntimeConfig("ogc", app.logger)
-    config = config_handler.tenant_config(tenant)
-    public_paths = config.get("public_paths", [])
-    if request.path in public_paths:
+    # NOTE: use auth settings of cached tenant OGC service instead of
+    #       reloading tenant config on every request
+    ogc_service = ogc_service_handler()
+    if request.path in ogc_service.public_paths:
         return
 
-    if config.get("auth_required", False):
-        ogc_service = ogc_service_handler()
+    if ogc_service.auth_required:
         identity = get_identity_or_auth(ogc_service)
         if identity is None:
             app.logger.info("Access denied, authentication required")
@@ -1,12 +1,21 @@
-from xml.etree import ElementTree
-import re
 from collections import OrderedDict
 
 from flask import json, Response
+from lxml import etree
 import requests
 
 
+# GML feature member tag
+GML_FEATURE_MEMBER_TAG = '{http://www.opengis.net/gml}featureMember'
+
+# QGIS attribute tags in GML features
+GML_QGS_ATTR_PREFIX = '{http://www.qgis.org/gml}'
+GML_QGS_ATTR_PREFIX_LEN = len(GML_QGS_ATTR_PREFIX)
+
+
 # Helper methods for WFS responses filtered by permissions
+# NOTE: XML is parsed with huge_tree, as lxml otherwise rejects text nodes
+#       larger than 10 MB (e.g. large GML geometries)
 
 
 def wfs_getcapabilities(response, params, permissions):
@@ -16,13 +25,13 @@ def wfs_getcapabilities(response, params, permissions):
     :param obj params: Request parameters
     :param obj permissions: OGC service permission
     """
-    xml = response.text
-
     if response.status_code == requests.codes.ok:
         # parse capabilities XML
-        ElementTree.register_namespace('', 'http://www.opengis.net/wfs')
-        ElementTree.register_namespace('ogc', 'http://www.opengis.net/ogc')
-        root = ElementTree.fromstring(xml)
+        # NOTE: parse XML from raw response stream
+        response.raw.decode_content = True
+        root = etree.parse(
+            response.raw, etree.XMLParser(huge_tree=True)
+        ).getroot()
 
         # use default namespace for XML search
         # namespace dict
@@ -37,9 +46,9 @@ def wfs_getcapabilities(response, params, permissions):
         # override OnlineResources
         wfs_url = permissions.get('online_resource')
         if wfs_url:
-            for online_resource in root.findall('.//%sGet' % (np), ns):
+            for online_resource in root.iterfind('.//%sGet' % (np), ns):
                 online_resource.set('onlineResource', wfs_url)
-            for online_resource in root.findall('.//%sPost' % (np), ns):
+            for online_resource in root.iterfind('.//%sPost' % (np), ns):
                 online_resource.set('onlineResource', wfs_url)
 
         # remove Transaction capability
@@ -65,8 +74,13 @@ def wfs_getcapabilities(response, params, permissions):
                     # remove not permitted layer
                     feature_type_list.remove(layer)
 
-            # write XML to string
-            xml = ElementTree.tostring(root, encoding='utf-8', method='xml')
+        # write XML to string
+        # NOTE: always serialize parsed XML, as the response stream has been
+        #       consumed (e.g. for a ServiceExceptionReport without
+        #       FeatureTypeList)
+        xml = etree.tostring(root, encoding='utf-8', method='xml')
+    else:
+        xml = response.text
 
     return Response(
         xml,
@@ -82,14 +96,13 @@ def wfs_describefeaturetype(response, params, permissions):
     :param obj params: Request parameters
     :param obj permissions: OGC service permission
     """
-    xml = response.text
-
     if response.status_code == requests.codes.ok:
         # parse capabilities XML
-        ElementTree.register_namespace(
-            '', 'http://www.w3.org/2001/XMLSchema'
-        )
-        root = ElementTree.fromstring(xml)
+        # NOTE: parse XML from raw response stream
+        response.raw.decode_content = True
+        root = etree.parse(
+            response.raw, etree.XMLParser(huge_tree=True)
+        ).getroot()
 
         # use default namespace for XML search
         # namespace dict
@@ -101,22 +114,31 @@ def wfs_describefeaturetype(response, params, permissions):
             ns = {}
             np = ''
 
-        for complex_type in root.findall('%scomplexType' % np, ns):
+        for complex_type in root.iterfind('%scomplexType' % np, ns):
             # get layer name
             layer_name = complex_type.get('name', 'Type')[:-4]
 
             # get permitted attributes for layer
-            permitted_attributes = permissions['layers'].get(layer_name, [])
+            permitted_attributes = permitted_layer_attributes(
+                layer_name, permissions
+            )
 
             sequence = complex_type.find('.//%ssequence' % np, ns)
-            for element in sequence.findall('%selement' % np, ns):
-                attr_name = element.get('name', '')
-                if attr_name not in permitted_attributes:
-                    # remove not permitted attribute
-                    sequence.remove(element)
+            element_tag = sequence.tag[:-len('sequence')] + 'element'
+            # remove not permitted attributes
+            # NOTE: rebuild children in a single pass
+            children = [
+                element for element in sequence
+                if element.tag != element_tag
+                or element.get('name', '') in permitted_attributes
+            ]
+            if len(children) != len(sequence):
+                sequence[:] = children
 
         # write XML to string
-        xml = ElementTree.tostring(root, encoding='utf-8', method='xml')
+        xml = etree.tostring(root, encoding='utf-8', method='xml')
+    else:
+        xml = response.text
 
     return Response(
         xml,
@@ -132,17 +154,19 @@ def wfs_getfeature(response, params, permissions):
     :param obj params: Request parameters
     :param obj permissions: OGC service permission
     """
-    features = response.text
-
     if response.status_code == requests.codes.ok:
         output_format = params.get('OUTPUTFORMAT')
         if output_format == 'GeoJSON':
             content_type = 'application/json'
-            features = wfs_getfeature_geojson(features, permissions)
+            features = wfs_getfeature_geojson(response.text, permissions)
         else:
             content_type = response.headers['content-type']
             gml3 = output_format == 'GML3'
-            features = wfs_getfeature_gml(features, gml3, permissions)
+            # NOTE: stream-parse GML from raw response
+            response.raw.decode_content = True
+            features = wfs_getfeature_gml(response.raw, gml3, permissions)
+    else:
+        features = response.text
 
     return Response(
         features,
@@ -151,51 +175,62 @@ def wfs_getfeature(response, params, permissions):
     )
 
 
-def wfs_getfeature_gml(features, gml3, permissions):
+def wfs_getfeature_gml(source, gml3, permissions):
     """Parse features GML and filter feature attributes by permission.
 
-    :param str features: Raw WFS GetFeature response from QGIS server
+    :param file source: Raw WFS GetFeature response stream from QGIS server
+    :param bool gml3: Whether features are GML3
     :param obj permissions: OGC service permission
     """
-    ElementTree.register_namespace('gml', 'http://www.opengis.net/gml')
-    ElementTree.register_namespace('qgs', 'http://www.qgis.org/gml')
-    ElementTree.register_namespace('wfs', 'http://www.opengis.net/wfs')
-    root = ElementTree.fromstring(features)
-
-    # namespace dict
-    ns = {
-        'gml': 'http://www.opengis.net/gml',
-        'qgs': 'http://www.qgis.org/gml'
-    }
-
-    qgs_attr_pattern = re.compile("^{%s}(.+)" % ns['qgs'])
-
     if gml3:
         fid_attr = '{http://www.opengis.net/gml}id'
     else:
         fid_attr = 'fid'
 
-    for feature in root.findall('./gml:featureMember', ns):
+    # permitted attributes per layer
+    attributes_cache = {}
+
+    # filter attributes of each feature member while parsing
+    context = etree.iterparse(
+        source, events=('end',), tag=GML_FEATURE_MEMBER_TAG, huge_tree=True
+    )
+    for event, feature in context:
+        parent = feature.getparent()
+        if parent is None or parent.getparent() is not None:
+            # skip any feature members not below root
+            continue
+
         for layer in feature:
+            if not isinstance(layer.tag, str):
+                # skip comments and processing instructions
+                continue
+
             # get layer name from fid, as spaces are removed in tag name
-            layer_name = '.'.join(layer.get(fid_attr, '').split('.')[:-1])
+            layer_name = layer.get(fid_attr, '').rpartition('.')[0]
 
             # get permitted attributes for layer
-            permitted_attributes = permissions['layers'].get(layer_name, [])
-
-            for attr in layer.findall('*'):
-                m = qgs_attr_pattern.match(attr.tag)
-                if m is not None:
-                    # attribute tag
-                    attr_name = m.group(1)
-                    if attr_name not in permitted_attributes:
-                        # remove not permitted attribute
-                        layer.remove(attr)
+            permitted_attributes = permitted_layer_attributes(
+                layer_name, permissions, attributes_cache
+            )
+
+            # remove not permitted attributes
+            # NOTE: rebuild children in a single pass
+            children = [
+                child for child in layer
+                if is_permitted_gml_child(child, permitted_attributes)
+            ]
+            if len(children) != len(layer):
+                layer[:] = children
+
+    root = context.root
+
+    # write empty elements with start and end tags
+    for el in root.iter():
+        if el.text is None and len(el) == 0:
+            el.text = ''
 
     # write XML to string
-    return ElementTree.tostring(
-        root, encoding='utf-8', method='xml', short_empty_elements=False
-    )
+    return etree.tostring(root, encoding='utf-8', method='xml')
 
 
 def wfs_getfeature_geojson(features, permissions):
@@ -207,12 +242,17 @@ def wfs_getfeature_geojson(features, permissions):
     # parse GeoJSON (preserve order)
     geo_json = json.loads(features, object_pairs_hook=OrderedDict)
 
+    # permitted attributes per layer
+    attributes_cache = {}
+
     for feature in geo_json.get('features', []):
         # get layer name from id
-        layer_name = '.'.join(feature.get('id', '').split('.')[:-1])
+        layer_name = feature.get('id', '').rpartition('.')[0]
 
         # get permitted attributes for layer
-        permitted_attributes = permissions['layers'].get(layer_name, [])
+        permitted_attributes = permitted_layer_attributes(
+            layer_name, permissions, attributes_cache
+        )
 
         properties = feature.get('properties', {})
         if properties:
@@ -227,3 +267,38 @@ def wfs_getfeature_geojson(features, permissions):
         geo_json, ensure_ascii=False,
         sort_keys=False
     )
+
+
+def is_permitted_gml_child(element, permitted_attributes):
+    """Return whether a GML feature child element is not a QGIS attribute
+    tag or a permitted attribute.
+
+    :param Element element: Child element of GML feature
+    :param set(str) permitted_attributes: Set of permitted attribute names
+    """
+    tag = element.tag
+    if (isinstance(tag, str) and tag.startswith(GML_QGS_ATTR_PREFIX) and
+            len(tag) > GML_QGS_ATTR_PREFIX_LEN):
+        # attribute tag
+        return tag[GML_QGS_ATTR_PREFIX_LEN:] in permitted_attributes
+
+    return True
+
+
+def permitted_layer_attributes(layer_name, permissions, cache=None):
+    """Get set of permitted attributes for a WFS layer.
+
+    :param str layer_name: WFS layer name
+    :param obj permissions: OGC service permissions
+    :param dict cache: Optional cache for permitted attributes per layer
+    """
+    if cache is not None and layer_name in cache:
+        return cache[layer_name]
+
+    permitted_attributes = permissions['layer_attributes'].get(
+        layer_name, frozenset()
+    )
+    if cache is not None:
+        cache[layer_name] = permitted_attributes
+
+    return permitted_attributes
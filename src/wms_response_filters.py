@@ -1,11 +1,103 @@
 import re
-from urllib.parse import urlparse, parse_qs, parse_qsl, urlencode
-from xml.etree import ElementTree
+from urllib.parse import urlparse, urlunparse, parse_qs, parse_qsl, \
+    urlencode
 
 from flask import Response
+from lxml import etree
 import requests
 
 
+# XML namespaces
+WMS_NS = 'http://www.opengis.net/wms'
+SLD_NS = 'http://www.opengis.net/sld'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+QGS_NS = 'http://www.qgis.org/wms'
+XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+
+# qualified xlink attribute names
+XLINK_HREF = '{%s}href' % XLINK_NS
+XLINK_TYPE = '{%s}type' % XLINK_NS
+
+
+def capabilities_xpaths(np):
+    """Return compiled XPath expressions for WMS capabilities.
+
+    :param str np: Namespace prefix for WMS elements ('ns:' or '')
+    """
+    paths = {
+        # OnlineResources to override with service URL
+        'online_resources': ' | '.join([
+            './/{np}Service/{np}OnlineResource',
+            './/{np}GetCapabilities//{np}OnlineResource',
+            './/{np}GetMap//{np}OnlineResource',
+            './/{np}GetFeatureInfo//{np}OnlineResource',
+            './/sld:GetLegendGraphic//{np}OnlineResource',
+            './/sld:DescribeLayer//{np}OnlineResource',
+            './/qgs:GetStyles//{np}OnlineResource',
+            './/{np}GetPrint//{np}OnlineResource',
+            './/{np}LegendURL//{np}OnlineResource'
+        ]),
+        'feature_info_online_resources':
+            './/{np}GetFeatureInfo//{np}OnlineResource',
+        'legend_url_online_resources':
+            './/{np}LegendURL//{np}OnlineResource',
+        'legend_graphic_online_resources':
+            './/sld:GetLegendGraphic//{np}OnlineResource',
+        'layers': './/{np}Layer',
+        # info formats of first GetFeatureInfo
+        'feature_info_formats': '(.//{np}GetFeatureInfo)[1]/{np}Format',
+        'layer_drawing_order': './/{np}LayerDrawingOrder',
+        'composer_templates': '{np}Capability/{np}ComposerTemplates'
+    }
+    namespaces = {'ns': WMS_NS, 'sld': SLD_NS, 'qgs': QGS_NS}
+    return {
+        key: etree.XPath(path.format(np=np), namespaces=namespaces)
+        for key, path in paths.items()
+    }
+
+
+# precompiled XPath expressions for WMS capabilities with and without
+# WMS namespace
+CAPABILITIES_XPATHS = {
+    'ns:': capabilities_xpaths('ns:'),
+    '': capabilities_xpaths('')
+}
+
+
+def capabilities_tags(wmsns):
+    """Return qualified tag names for WMS capabilities elements.
+
+    :param str wmsns: WMS namespace in Clark notation or ''
+    """
+    names = [
+        'Attribute', 'Attributes', 'Capability', 'ComposerTemplate', 'Format',
+        'Layer', 'LegendURL', 'Name', 'OnlineResource', 'Style', 'Title'
+    ]
+    return {name: wmsns + name for name in names}
+
+
+# qualified tag names for WMS capabilities with and without WMS namespace
+CAPABILITIES_TAGS = {
+    'ns:': capabilities_tags('{%s}' % WMS_NS),
+    '': capabilities_tags('')
+}
+
+
+# precompiled regex patterns
+# GetSchemaExtension URL in xsi:schemaLocation
+SCHEMA_EXTENSION_URL_PATTERN = re.compile(
+    r'(https?:\/\/[^\s]*REQUEST=GetSchemaExtension[^\s]*)', re.IGNORECASE
+)
+# quoted attribute values in text/plain feature info
+PLAIN_QUOTED_VALUE_PATTERN = re.compile(r"(\w+)\s*=\s*'(.*?)'(?:\n|$)", re.DOTALL)
+# linebreaks in values of text/html feature info
+HTML_LINEBREAK_PATTERN = re.compile(r'([^>])\n')
+
+# QGIS attribute tags in GML feature info
+GML_QGS_ATTR_PREFIX = '{http://qgis.org/gml}'
+GML_QGS_ATTR_PREFIX_LEN = len(GML_QGS_ATTR_PREFIX)
+
+
 # Helper methods for WMS responses filtered by permissions
 
 
@@ -19,218 +111,194 @@ def wms_getcapabilities(response, host_url, params, script_root, permissions):
     :param str script_root: Request root path
     :param obj permissions: OGC service permissions
     """
-    xml = response.text
-
-    if response.status_code == requests.codes.ok:
-        # parse capabilities XML
-        sldns = 'http://www.opengis.net/sld'
-        xlinkns = 'http://www.w3.org/1999/xlink'
-        qgsns = 'http://www.qgis.org/wms'
-        xsins = 'http://www.w3.org/2001/XMLSchema-instance'
-        ElementTree.register_namespace('', 'http://www.opengis.net/wms')
-        ElementTree.register_namespace('qgs', qgsns)
-        ElementTree.register_namespace('sld', sldns)
-        ElementTree.register_namespace('xlink', xlinkns)
-        root = ElementTree.fromstring(xml)
-
-        # use default namespace for XML search
-        # namespace dict
-        ns = {
-            'ns': 'http://www.opengis.net/wms',
-            'sld': sldns,
-            'qgs': qgsns
-        }
-        # namespace prefix
-        np = 'ns:'
-        if not root.tag.startswith('{http://'):
-            # do not use namespace
-            ns = {}
-            np = ''
-
-        service_url = permissions['online_resources'].get('service')
-        if not service_url:
-            # default OnlineResource from request URL parts
-            # e.g. '//example.com/ows/qwc_demo'
-            service_url = "//%s%s/%s" % (
-                urlparse(host_url).netloc, script_root, permissions.get('service_name')
-            )
+    if response.status_code != requests.codes.ok:
+        return Response(
+            response.content,
+            content_type=response.headers['content-type'],
+            status=response.status_code
+        )
 
-        # override GetSchemaExtension URL in xsi:schemaLocation
-        update_schema_location(root, service_url, xsins)
-
-        # override OnlineResources
-        online_resources = []
-        online_resources += root.findall('.//%sService/%sOnlineResource' % (np, np), ns)
-        online_resources += root.findall('.//%sGetCapabilities//%sOnlineResource' % (np, np), ns)
-        online_resources += root.findall('.//%sGetMap//%sOnlineResource' % (np, np), ns)
-        online_resources += root.findall('.//%sGetFeatureInfo//%sOnlineResource' % (np, np), ns)
-        online_resources += root.findall('.//{%s}GetLegendGraphic//%sOnlineResource' % (sldns, np), ns)
-        online_resources += root.findall('.//{%s}DescribeLayer//%sOnlineResource' % (sldns, np), ns)
-        online_resources += root.findall('.//{%s}GetStyles//%sOnlineResource' % (qgsns, np), ns)
-        online_resources += root.findall('.//%sGetPrint//%sOnlineResource' % (np, np), ns)
-        online_resources += root.findall('.//%sLegendURL//%sOnlineResource' % (np, np), ns)
+    permitted_layers = permissions['public_layers']
+    queryable_layers = permissions['queryable_layers']
+    layer_attributes = permissions['layer_attributes']
+
+    # stream-parse capabilities XML and filter layers by permissions
+    # while parsing
+    # NOTE: sublayers are complete on their end event, before their parent
+    # NOTE: allow text nodes larger than 10 MB with huge_tree
+    response.raw.decode_content = True
+    context = etree.iterparse(
+        response.raw, events=('end',), tag=('{%s}Layer' % WMS_NS, 'Layer'),
+        huge_tree=True
+    )
+    for event, layer in context:
+        parent = layer.getparent()
+        if parent is None or parent.tag != layer.tag:
+            # skip root layer
+            continue
+
+        # NOTE: use qualified tags for child lookups
+        tags = CAPABILITIES_TAGS['ns:' if layer.tag[0] == '{' else '']
+
+        layer_name = layer.find(tags['Name']).text
+        if layer_name not in permitted_layers:
+            # remove not permitted layer
+            parent.remove(layer)
+            layer.clear()
+            continue
+
+        # update queryable
+        if layer_name in queryable_layers:
+            layer.set('queryable', '1')
+        else:
+            layer.set('queryable', '0')
 
+        # get permitted attributes for layer
+        permitted_attributes = layer_attributes.get(layer_name, frozenset())
+
+        # remove layer displayField if attribute not permitted
+        # (for QGIS GetProjectSettings)
+        display_field = layer.get('displayField')
+        if display_field and display_field not in permitted_attributes:
+            layer.attrib.pop('displayField')
+
+        # filter layer attributes by permissions
+        # (for QGIS GetProjectSettings)
+        attributes = layer.find(tags['Attributes'])
+        if attributes is not None:
+            # remove not permitted attributes
+            # NOTE: rebuild children in a single pass
+            children = [
+                attr for attr in attributes
+                if attr.tag != tags['Attribute']
+                or attr.get('name') in permitted_attributes
+            ]
+            if len(children) != len(attributes):
+                attributes[:] = children
+
+    root = context.root
+
+    # use default namespace for XML search
+    # namespace prefix for compiled XPaths
+    np = 'ns:'
+    if not root.tag.startswith('{http://'):
+        # do not use namespace
+        np = ''
+    xpaths = CAPABILITIES_XPATHS[np]
+    # qualified tag names for element lookups and new elements
+    tags = CAPABILITIES_TAGS[np]
+
+    service_url = permissions['online_resources'].get('service')
+    if not service_url:
+        # default OnlineResource from request URL parts
+        # e.g. '//example.com/ows/qwc_demo'
+        service_url = "//%s%s/%s" % (
+            urlparse(host_url).netloc, script_root, permissions.get('service_name')
+        )
+
+    # override GetSchemaExtension URL in xsi:schemaLocation
+    update_schema_location(root, service_url, XSI_NS)
+
+    # override OnlineResources
+    update_online_resources(
+        xpaths['online_resources'](root), service_url, XLINK_NS, host_url
+    )
+
+    info_url = permissions['online_resources'].get('feature_info')
+    if info_url:
+        # override GetFeatureInfo OnlineResources
+        online_resources = xpaths['feature_info_online_resources'](root)
         update_online_resources(
-            online_resources, service_url, xlinkns, host_url
+            online_resources, info_url, XLINK_NS, host_url
         )
 
-        info_url = permissions['online_resources'].get('feature_info')
-        if info_url:
-            # override GetFeatureInfo OnlineResources
-            online_resources = root.findall(
-                './/%sGetFeatureInfo//%sOnlineResource' % (np, np), ns
-            )
-            update_online_resources(
-                online_resources, info_url, xlinkns, host_url
-            )
+    legend_url = permissions['online_resources'].get('legend')
+    if legend_url:
+        # override GetLegend OnlineResources
+        online_resources = xpaths['legend_url_online_resources'](root)
+        online_resources += xpaths['legend_graphic_online_resources'](root)
+        update_online_resources(
+            online_resources, legend_url, XLINK_NS, host_url
+        )
 
-        legend_url = permissions['online_resources'].get('legend')
-        if legend_url:
-            # override GetLegend OnlineResources
-            online_resources = root.findall(
-                './/%sLegendURL//%sOnlineResource' % (np, np), ns
-            )
-            online_resources += root.findall(
-                './/{%s}GetLegendGraphic//%sOnlineResource' % (sldns, np),
-                ns
-            )
-            update_online_resources(
-                online_resources, legend_url, xlinkns, host_url
-            )
+        # HACK: Inject LegendURL for group layers (which are missing LegendURL)
+        # Pending proper upstream QGIS server fix
+        # Take first online_resource and tweak the URL
+        refUrl = urlparse(online_resources[0].get(XLINK_HREF))
+        refQuery = dict(parse_qsl(refUrl.query))
+        refFmt = refQuery.get('FORMAT','image/png')
 
-            # HACK: Inject LegendURL for group layers (which are missing LegendURL)
-            # Pending proper upstream QGIS server fix
-            # Take first online_resource and tweak the URL
-            refUrl = urlparse(online_resources[0].get('{%s}href' % xlinkns))
-            refQuery = dict(parse_qsl(refUrl.query))
-            refFmt = refQuery.get('FORMAT','image/png')
-
-            layers = root.findall('.//%sLayer' % np, ns)
-            for layerEl in layers:
-                styleEl = layerEl.find('%sStyle' % np, ns)
-                if styleEl is None:
-
-                    styleEl = ElementTree.Element('Style')
-                    layerEl.append(styleEl)
-
-                    nameEl = ElementTree.Element('Name')
-                    nameEl.text = 'default'
-                    styleEl.append(nameEl)
-
-                    titleEl = ElementTree.Element('Title')
-                    titleEl.text = 'default'
-                    styleEl.append(titleEl)
-
-                legendUrlEl = styleEl.find('%sLegendURL' % np, ns)
-                nameEl = layerEl.find('%sName' % np, ns)
-                if legendUrlEl is None and nameEl is not None:
-                    refQuery['LAYER'] = nameEl.text
-                    refUrl = refUrl._replace(query = urlencode(refQuery, doseq=True))
-
-                    legendUrlEl = ElementTree.Element('LegendURL')
-                    styleEl.append(legendUrlEl)
-
-                    formatEl = ElementTree.Element('Format')
-                    formatEl.text = refFmt
-                    legendUrlEl.append(formatEl)
-
-                    onlineResourceEl = ElementTree.Element('OnlineResource', {
-                        '{%s}href' % xlinkns: refUrl.geturl(),
-                        '{%s}type' % xlinkns: 'simple'
-                    })
-                    legendUrlEl.append(onlineResourceEl)
-
-
-        root_layer = root.find('%sCapability/%sLayer' % (np, np), ns)
-        if root_layer is not None:
-            # remove broken info format 'application/vnd.ogc.gml/3.1.1'
-            feature_info = root.find('.//%sGetFeatureInfo' % np, ns)
-            if feature_info is not None:
-                for format in feature_info.findall('%sFormat' % np, ns):
-                    if format.text == 'application/vnd.ogc.gml/3.1.1':
-                        feature_info.remove(format)
-
-            # filter and update layers by permissions
-            permitted_layers = permissions['public_layers']
-            queryable_layers = permissions['queryable_layers']
-            for group in root_layer.findall('.//%sLayer/..' % np, ns):
-                for layer in group.findall('%sLayer' % np, ns):
-                    layer_name = layer.find('%sName' % np, ns).text
-                    if layer_name not in permitted_layers:
-                        # remove not permitted layer
-                        group.remove(layer)
-                    else:
-                        # update queryable
-                        if layer_name in queryable_layers:
-                            layer.set('queryable', '1')
-                        else:
-                            layer.set('queryable', '0')
+        for layerEl in xpaths['layers'](root):
+            styleEl = layerEl.find(tags['Style'])
+            if styleEl is None:
 
-                    # get permitted attributes for layer
-                    permitted_attributes = permissions['layers'].get(
-                        layer_name, {}
-                    )
+                styleEl = etree.SubElement(layerEl, tags['Style'])
 
-                    # remove layer displayField if attribute not permitted
-                    # (for QGIS GetProjectSettings)
-                    display_field = layer.get('displayField')
-                    if (display_field and
-                            display_field not in permitted_attributes):
-                        layer.attrib.pop('displayField')
-
-                    # filter layer attributes by permissions
-                    # (for QGIS GetProjectSettings)
-                    attributes = layer.find('%sAttributes' % np, ns)
-                    if attributes is not None:
-                        for attr in attributes.findall(
-                            '%sAttribute' % np, ns
-                        ):
-                            if attr.get('name') not in permitted_attributes:
-                                # remove not permitted attribute
-                                attributes.remove(attr)
-
-            # update queryable for root layer
-            if queryable_layers:
-                root_layer.set('queryable', '1')
-            else:
-                root_layer.set('queryable', '0')
-
-            # filter LayerDrawingOrder by permissions
-            # (for QGIS GetProjectSettings)
-            layer_drawing_order = root.find(
-                './/%sLayerDrawingOrder' % np, ns
-            )
-            if layer_drawing_order is not None:
-                layers = layer_drawing_order.text.split(',')
+                nameEl = etree.SubElement(styleEl, tags['Name'])
+                nameEl.text = 'default'
+
+                titleEl = etree.SubElement(styleEl, tags['Title'])
+                titleEl.text = 'default'
+
+            legendUrlEl = styleEl.find(tags['LegendURL'])
+            nameEl = layerEl.find(tags['Name'])
+            if legendUrlEl is None and nameEl is not None:
+                refQuery['LAYER'] = nameEl.text
+                refUrl = refUrl._replace(query = urlencode(refQuery, doseq=True))
+
+                legendUrlEl = etree.SubElement(
+                    styleEl, tags['LegendURL']
+                )
+
+                formatEl = etree.SubElement(legendUrlEl, tags['Format'])
+                formatEl.text = refFmt
+
+                etree.SubElement(legendUrlEl, tags['OnlineResource'], {
+                    XLINK_HREF: refUrl.geturl(),
+                    XLINK_TYPE: 'simple'
+                })
+
+
+    root_layer = root.find(tags['Capability'] + '/' + tags['Layer'])
+    if root_layer is not None:
+        # remove broken info format 'application/vnd.ogc.gml/3.1.1'
+        for format in xpaths['feature_info_formats'](root):
+            if format.text == 'application/vnd.ogc.gml/3.1.1':
+                format.getparent().remove(format)
+
+        # update queryable for root layer
+        if queryable_layers:
+            root_layer.set('queryable', '1')
+        else:
+            root_layer.set('queryable', '0')
+
+        # filter LayerDrawingOrder by permissions
+        # (for QGIS GetProjectSettings)
+        for layer_drawing_order in xpaths['layer_drawing_order'](root)[:1]:
+            layers = layer_drawing_order.text.split(',')
+            if not permitted_layers.issuperset(layers):
                 # remove not permitted layers
                 layers = [
                     l for l in layers if l in permitted_layers
                 ]
                 layer_drawing_order.text = ','.join(layers)
 
-            # filter ComposerTemplates by permissions
-            # (for QGIS GetProjectSettings)
-            templates = root.find(
-                '%sCapability/%sComposerTemplates' % (np, np), ns
-            )
-            if templates is not None:
-                permitted_templates = permissions.get('print_templates', [])
-                for template in templates.findall(
-                    '%sComposerTemplate' % np, ns
-                ):
-                    template_name = template.get('name')
-                    if template_name not in permitted_templates:
-                        # remove not permitted print template
-                        templates.remove(template)
-
-                if not templates.find('%sComposerTemplate' % np, ns):
-                    # remove ComposerTemplates if empty
-                    root.find('%sCapability' % np, ns).remove(templates)
-
-            # write XML to string
-            xml = ElementTree.tostring(
-                root, encoding='utf-8', method='xml'
-            )
+        # filter ComposerTemplates by permissions
+        # (for QGIS GetProjectSettings)
+        for templates in xpaths['composer_templates'](root)[:1]:
+            permitted_templates = permissions.get('print_templates', [])
+            for template in templates.findall(tags['ComposerTemplate']):
+                template_name = template.get('name')
+                if template_name not in permitted_templates:
+                    # remove not permitted print template
+                    templates.remove(template)
+
+            if templates.find(tags['ComposerTemplate']) is None:
+                # remove ComposerTemplates if empty
+                templates.getparent().remove(templates)
+
+    # write XML to string
+    xml = etree.tostring(root, encoding='utf-8', method='xml')
 
     return Response(
         xml,
@@ -256,11 +324,7 @@ def update_schema_location(capabilities, new_url, xsins):
     if schema_location:
         # extract GetSchemaExtension URL
         # e.g. http://...?SERVICE=WMS&REQUEST=GetSchemaExtension
-        match = re.search(
-            r'(https?:\/\/[^\s]*REQUEST=GetSchemaExtension[^\s]*)',
-            schema_location,
-            re.IGNORECASE
-        )
+        match = SCHEMA_EXTENSION_URL_PATTERN.search(schema_location)
         if match:
             schema_extension_url = match.group(1)
 
@@ -294,25 +358,36 @@ def update_online_resources(elements, new_url, xlinkns, host_url):
     netloc = url.netloc if url.netloc else host_url_parts.netloc
     path = url.path
 
-    for online_resource in elements:
-        # update OnlineResource URL
-        url = urlparse(online_resource.get('{%s}href' % xlinkns))
-        if not url.scheme.startswith('http'):
-            continue
-        url = url._replace(scheme=scheme)
-        url = url._replace(netloc=netloc)
-        url = url._replace(path=path)
-
-        # Drop MAP query parameter, it is never useful for services served through qwc-qgis-server
-        query = parse_qs(url.query)
-        query_keys = list(query.keys())
-        for key in query_keys:
-            if key.lower() == "map":
-                del query[key]
+    href_attr = '{%s}href' % xlinkns
 
-        url = url._replace(query = urlencode(query, doseq=True))
+    # lookup for updated URLs as {<original URL>: <updated URL>}
+    # NOTE: many OnlineResources share the same URL
+    updated_urls = {}
 
-        online_resource.set('{%s}href' % xlinkns, url.geturl())
+    for online_resource in elements:
+        # update OnlineResource URL
+        href = online_resource.get(href_attr)
+        updated_url = updated_urls.get(href)
+        if updated_url is None:
+            url = urlparse(href)
+            if not url.scheme.startswith('http'):
+                continue
+
+            # Drop MAP query parameter, it is never useful for services served through qwc-qgis-server
+            query = parse_qs(url.query)
+            query_keys = list(query.keys())
+            for key in query_keys:
+                if key.lower() == "map":
+                    del query[key]
+
+            # NOTE: keep any ';params' of the original URL path
+            updated_url = urlunparse((
+                scheme, netloc, path, url.params,
+                urlencode(query, doseq=True), url.fragment
+            ))
+            updated_urls[href] = updated_url
+
+        online_resource.set(href_attr, updated_url)
 
 
 def wms_getfeatureinfo(response, params, permissions):
@@ -322,40 +397,47 @@ def wms_getfeatureinfo(response, params, permissions):
     :param obj params: Request parameters
     :param obj permissions: OGC service permissions
     """
-    feature_info = response.text
-
-    if response.status_code == requests.codes.ok:
-        info_format = params.get('INFO_FORMAT', 'text/plain')
-        if info_format == 'text/plain':
-            feature_info = wms_getfeatureinfo_plain(
-                feature_info, permissions
-            )
-        elif info_format == 'text/html':
-            feature_info = wms_getfeatureinfo_html(
-                feature_info, permissions
-            )
-        elif info_format == 'text/xml':
-            feature_info = wms_getfeatureinfo_xml(
-                feature_info, permissions
-            )
-        elif info_format == 'application/vnd.ogc.gml':
-            feature_info = wms_getfeatureinfo_gml(
-                feature_info, permissions
-            )
-        else:
-            service_exception = (
-                '<ServiceExceptionReport version="1.3.0">\n'
-                ' <ServiceException code="InvalidFormat">Unsupported info_format</ServiceException>\n'
-                '</ServiceExceptionReport>'
-            )
-            return Response(
-                service_exception,
-                content_type='text/xml; charset=utf-8',
-                status=200
-            )
+    if response.status_code != requests.codes.ok:
+        return Response(
+            response.content,
+            content_type=response.headers['content-type'],
+            status=response.status_code
+        )
 
+    info_format = params.get('INFO_FORMAT', 'text/plain')
+    if info_format == 'text/plain':
+        feature_info = wms_getfeatureinfo_plain(
+            response.text, permissions
+        )
+    elif info_format == 'text/html':
+        feature_info = wms_getfeatureinfo_html(
+            response.text, permissions
+        )
+    elif info_format == 'text/xml':
+        # NOTE: stream-parse XML from raw response
+        response.raw.decode_content = True
+        feature_info = wms_getfeatureinfo_xml(
+            response.raw, permissions
+        )
+    elif info_format == 'application/vnd.ogc.gml':
+        # NOTE: stream-parse GML from raw response
+        response.raw.decode_content = True
+        feature_info = wms_getfeatureinfo_gml(
+            response.raw, permissions
+        )
+    else:
+        service_exception = (
+            '<ServiceExceptionReport version="1.3.0">\n'
+            ' <ServiceException code="InvalidFormat">Unsupported info_format</ServiceException>\n'
+            '</ServiceExceptionReport>'
+        )
+        return Response(
+            service_exception,
+            content_type='text/xml; charset=utf-8',
+            status=200
+        )
 
-        # NOTE: application/vnd.ogc.gml/3.1.1 is broken in QGIS server
+    # NOTE: application/vnd.ogc.gml/3.1.1 is broken in QGIS server
 
     return Response(
         feature_info,
@@ -382,37 +464,41 @@ def wms_getfeatureinfo_plain(feature_info, permissions):
     """
 
     # Replace linebreaks in quoted values which break line-based parsing below
-    def remove_linebreaks(match):
-        return "%s = '%s'\n" % (match.group(1), match.group(2).replace('\n', ' '))
-
-    feature_info = re.sub(r"(\w+)\s*=\s*'(.*?)'(?:\n|$)", remove_linebreaks, feature_info, flags=re.DOTALL)
+    feature_info = PLAIN_QUOTED_VALUE_PATTERN.sub(
+        remove_quoted_value_linebreaks, feature_info
+    )
 
     if feature_info.startswith('GetFeatureInfo'):
         lines = []
 
-        layer_pattern = re.compile("^Layer '(.+)'$")
-        attr_pattern = re.compile("^(.+) = .+$")
-        permitted_attributes = {}
+        permitted_attributes = set()
+        # permitted attributes per info layer
+        attributes_cache = {}
 
         # filter feature attributes by permissions
+        # NOTE: use plain string operations instead of regex matching
+        #       for attribute lines ("<attr> = <value>") and
+        #       layer lines ("Layer '<layer>'")
         for line in feature_info.splitlines():
-            m = attr_pattern.match(line)
-            if m is not None:
+            # find last ' = ' with non-empty name and value
+            pos = line.rfind(' = ', 1, len(line) - 1)
+            if pos != -1:
                 # attribute line
                 # check if layer attribute is permitted
-                attr = m.group(1)
+                attr = line[:pos]
                 if attr not in permitted_attributes:
                     # skip not permitted attribute
                     continue
-            else:
-                m = layer_pattern.match(line)
-                if m is not None:
-                    # layer line
-                    # get permitted attributes for layer
-                    current_layer = m.group(1)
-                    permitted_attributes = permitted_info_attributes(
-                        current_layer, permissions
-                    )
+            elif (
+                len(line) > 8 and line.startswith("Layer '")
+                and line.endswith("'")
+            ):
+                # layer line
+                # get permitted attributes for layer
+                current_layer = line[7:-1]
+                permitted_attributes = permitted_info_attributes(
+                    current_layer, permissions, attributes_cache
+                )
 
             # keep line
             lines.append(line)
@@ -423,6 +509,15 @@ def wms_getfeatureinfo_plain(feature_info, permissions):
     return feature_info
 
 
+def remove_quoted_value_linebreaks(match):
+    """Return attribute line of PLAIN_QUOTED_VALUE_PATTERN match
+    without linebreaks in quoted value.
+
+    :param re.Match match: Match of attribute name and quoted value
+    """
+    return "%s = '%s'\n" % (match.group(1), match.group(2).replace('\n', ' '))
+
+
 def wms_getfeatureinfo_html(feature_info, permissions):
     """Parse feature info HTML and filter feature attributes by permissions.
 
@@ -432,42 +527,46 @@ def wms_getfeatureinfo_html(feature_info, permissions):
     # NOTE: info content is not valid XML, parse as text
 
     # Replace linebreaks in values which break line-based parsing below
-    feature_info = re.sub(r'([^>])\n', r'\1 ', feature_info)
+    feature_info = HTML_LINEBREAK_PATTERN.sub(r'\1 ', feature_info)
 
     if feature_info.startswith('<HEAD>'):
         lines = []
 
-        layer_pattern = re.compile(
-            r"^<TR>.+>Layer<\/TH><TD>(.+)<\/TD><\/TR>$"
-        )
-        table_pattern = re.compile("^.*<TABLE")
-        attr_pattern = re.compile(r"^<TR><TH>(.+)<\/TH><TD>.+</TD><\/TR>$")
         next_tr_is_feature = False
-        permitted_attributes = {}
+        permitted_attributes = set()
+        # permitted attributes per info layer
+        attributes_cache = {}
 
+        # NOTE: use plain string operations instead of regex matching
+        #       for attribute rows ("<TR><TH><attr></TH><TD><value></TD></TR>")
+        #       and layer rows ("<TR>...>Layer</TH><TD><layer></TD></TR>")
         for line in feature_info.splitlines():
-            m = attr_pattern.match(line)
-            if m is not None:
+            pos = -1
+            if line.startswith('<TR><TH>') and line.endswith('</TD></TR>'):
+                # find last '</TH><TD>' with non-empty name and value
+                pos = line.rfind('</TH><TD>', 9, len(line) - 11)
+
+            if pos != -1:
                 # attribute line
                 # check if layer attribute is permitted
-                attr = m.group(1)
+                attr = line[8:pos]
                 if next_tr_is_feature:
                     # keep 'Feature', filter subsequent attributes
                     next_tr_is_feature = False
                 elif attr not in permitted_attributes:
                     # skip not permitted attribute
                     continue
-            elif table_pattern.match(line):
+            elif '<TABLE' in line:
                 # mark next tr as 'Feature'
                 next_tr_is_feature = True
-            else:
-                m = layer_pattern.match(line)
-                if m is not None:
+            elif line.startswith('<TR>') and line.endswith('</TD></TR>'):
+                pos = line.rfind('>Layer</TH><TD>', 5, len(line) - 11)
+                if pos != -1:
                     # layer line
                     # get permitted attributes for layer
-                    current_layer = m.group(1)
+                    current_layer = line[pos + 15:-10]
                     permitted_attributes = permitted_info_attributes(
-                        current_layer, permissions
+                        current_layer, permissions, attributes_cache
                     )
 
             # keep line
@@ -479,84 +578,134 @@ def wms_getfeatureinfo_html(feature_info, permissions):
     return feature_info
 
 
-def wms_getfeatureinfo_xml(feature_info, permissions):
+def wms_getfeatureinfo_xml(source, permissions):
     """Parse feature info XML and filter feature attributes by permissions.
 
-    :param str feature_info: Raw feature info response from QGIS server
+    :param file source: Raw feature info response stream from QGIS server
     :param obj permissions: OGC service permissions
     """
-    ElementTree.register_namespace('', 'http://www.opengis.net/ogc')
-    root = ElementTree.fromstring(feature_info)
+    # permitted attributes per info layer
+    attributes_cache = {}
+
+    # filter attributes of each feature while parsing
+    # NOTE: allow text nodes larger than 10 MB with huge_tree
+    context = etree.iterparse(
+        source, events=('end',), tag='Feature', huge_tree=True
+    )
+    for event, feature in context:
+        layer = feature.getparent()
+        if layer is None or layer.tag != 'Layer':
+            continue
 
-    for layer in root.findall('./Layer'):
         # get permitted attributes for layer
         permitted_attributes = permitted_info_attributes(
-            layer.get('name'), permissions
+            layer.get('name'), permissions, attributes_cache
         )
 
-        for feature in layer.findall('Feature'):
-            for attr in feature.findall('Attribute'):
-                if attr.get('name') not in permitted_attributes:
-                    # remove not permitted attribute
-                    feature.remove(attr)
+        # remove not permitted attributes
+        # NOTE: rebuild children in a single pass
+        children = [
+            attr for attr in feature
+            if attr.tag != 'Attribute'
+            or attr.get('name') in permitted_attributes
+        ]
+        if len(children) != len(feature):
+            feature[:] = children
 
     # write XML to string
-    return ElementTree.tostring(root, encoding='utf-8', method='xml')
+    return etree.tostring(context.root, encoding='utf-8', method='xml')
 
 
-def wms_getfeatureinfo_gml(feature_info, permissions):
+def wms_getfeatureinfo_gml(source, permissions):
     """Parse feature info GML and filter feature attributes by permissions.
 
-    :param str feature_info: Raw feature info response from QGIS server
+    :param file source: Raw feature info response stream from QGIS server
     :param obj permissions: OGC service permissions
     """
-    ElementTree.register_namespace('gml', 'http://www.opengis.net/gml')
-    ElementTree.register_namespace('qgs', 'http://qgis.org/gml')
-    ElementTree.register_namespace('wfs', 'http://www.opengis.net/wfs')
-    root = ElementTree.fromstring(feature_info)
-
     # namespace dict
     ns = {
         'gml': 'http://www.opengis.net/gml',
         'qgs': 'http://qgis.org/gml'
     }
 
-    qgs_attr_pattern = re.compile("^{%s}(.+)" % ns['qgs'])
+    # permitted attributes per info layer
+    attributes_cache = {}
 
-    for feature in root.findall('./gml:featureMember', ns):
+    # filter attributes of each feature member while parsing
+    # NOTE: allow text nodes larger than 10 MB with huge_tree
+    context = etree.iterparse(
+        source, events=('end',), tag='{%s}featureMember' % ns['gml'],
+        huge_tree=True
+    )
+    for event, feature in context:
         for layer in feature:
+            if not isinstance(layer.tag, str):
+                # skip comments and processing instructions
+                continue
+
             # get layer name from fid, as spaces are removed in tag name
-            layer_name = '.'.join(layer.get('fid', '').split('.')[:-1])
+            layer_name = layer.get('fid', '').rpartition('.')[0]
 
             # get permitted attributes for layer
             permitted_attributes = permitted_info_attributes(
-                layer_name, permissions
+                layer_name, permissions, attributes_cache
             )
 
-            for attr in layer.findall('*'):
-                m = qgs_attr_pattern.match(attr.tag)
-                if m is not None:
-                    # attribute tag
-                    attr_name = m.group(1)
-                    if attr_name not in permitted_attributes:
-                        # remove not permitted attribute
-                        layer.remove(attr)
+            # remove not permitted attributes
+            # NOTE: rebuild children in a single pass
+            children = [
+                child for child in layer
+                if is_permitted_gml_child(child, permitted_attributes)
+            ]
+            if len(children) != len(layer):
+                layer[:] = children
+
+    root = context.root
+
+    # write empty elements with start and end tags
+    for el in root.iter():
+        if el.text is None and len(el) == 0:
+            el.text = ''
 
     # write XML to string
-    return ElementTree.tostring(
-        root, encoding='utf-8', method='xml', short_empty_elements=False
-    )
+    return etree.tostring(root, encoding='utf-8', method='xml')
+
 
+def is_permitted_gml_child(element, permitted_attributes):
+    """Return whether a GML feature child element is not a QGIS attribute
+    tag or a permitted attribute.
 
-def permitted_info_attributes(info_layer_name, permissions):
+    :param Element element: Child element of GML feature
+    :param set(str) permitted_attributes: Set of permitted attribute names
+    """
+    tag = element.tag
+    if (isinstance(tag, str) and tag.startswith(GML_QGS_ATTR_PREFIX) and
+            len(tag) > GML_QGS_ATTR_PREFIX_LEN):
+        # attribute tag
+        return tag[GML_QGS_ATTR_PREFIX_LEN:] in permitted_attributes
+
+    return True
+
+
+def permitted_info_attributes(info_layer_name, permissions, cache=None):
     """Get permitted attributes for a feature info result layer.
 
     :param str info_layer_name: Layer name from feature info result
     :param obj permissions: OGC service permissions
+    :param dict cache: Optional cache for permitted attributes per layer
     """
+    if cache is not None and info_layer_name in cache:
+        return cache[info_layer_name]
+
     # get WMS layer name for info result layer
     wms_layer_name = permissions.get('feature_info_aliases', {}) \
         .get(info_layer_name, info_layer_name)
 
-    # return permitted attributes for layer
-    return permissions['layers'].get(wms_layer_name, {})
+    # permitted attributes for layer
+    permitted_attributes = permissions['layer_attributes'].get(
+        wms_layer_name, frozenset()
+    )
+    if cache is not None:
+        cache[info_layer_name] = permitted_attributes
+
+    return permitted_attributes
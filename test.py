@@ -1,6 +1,9 @@
 import unittest
 
 from tests.api_tests import *
+from tests.ogc_service_tests import *
+from tests.wfs_response_filters_tests import *
+from tests.wms_response_filters_tests import *
 
 
 if __name__ == '__main__':
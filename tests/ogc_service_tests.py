@@ -0,0 +1,466 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from lxml import etree
+from werkzeug.exceptions import BadRequest
+
+from ogc_service import OGCService, service_exception_xml
+
+
+# OGC service config for tests
+OGC_CONFIG = {
+    'service': 'ogc',
+    'config': {
+        'default_qgis_server_url': 'http://localhost:8001/ows/'
+    },
+    'resources': {
+        'wms_services': [
+            {
+                'name': 'qwc_demo',
+                'root_layer': {
+                    'name': 'qwc_demo',
+                    'layers': [
+                        {
+                            'name': 'edit_demo',
+                            'layers': [
+                                {'name': 'edit_points', 'queryable': True,
+                                 'attributes': ['id', 'name', 'secret']},
+                                {'name': 'edit_lines'}
+                            ]
+                        },
+                        {'name': 'countries'}
+                    ]
+                },
+                'print_url': 'http://print.example.com/ows/qwc_demo'
+            }
+        ],
+        'wfs_services': [
+            {
+                'name': 'qwc_demo',
+                'wfs_url': 'http://localhost:8001/wfs/qwc_demo',
+                'layers': [
+                    {'name': 'edit_points', 'attributes': ['id', 'name']}
+                ]
+            }
+        ]
+    }
+}
+
+# marker config options for tests
+MARKER_CONFIG = {
+    'marker_template': '<Fill>$FILL$</Fill><Label>$LABEL$</Label>',
+    'marker_params': {
+        'fill': {'default': 'FFFFFF', 'type': 'color'},
+        'label': {'default': 'x', 'type': 'string'}
+    }
+}
+
+# permissions for tests
+PERMISSIONS = {
+    'users': [{'name': 'demo', 'groups': [], 'roles': []}],
+    'groups': [{'name': 'editors', 'roles': ['editor']}],
+    'roles': [
+        {
+            'role': 'public',
+            'permissions': {
+                'wms_services': [{
+                    'name': 'qwc_demo',
+                    'layers': [
+                        {'name': 'qwc_demo'},
+                        {'name': 'countries'}
+                    ]
+                }]
+            }
+        },
+        {
+            'role': 'editor',
+            'permissions': {
+                'wms_services': [{
+                    'name': 'qwc_demo',
+                    'layers': [
+                        {'name': 'edit_demo'},
+                        {'name': 'edit_points', 'attributes': ['id', 'name']},
+                        {'name': 'edit_lines'}
+                    ]
+                }]
+            }
+        }
+    ]
+}
+
+
+class OGCServiceTestCase(unittest.TestCase):
+    """Test case for OGC service"""
+
+    def setUp(self):
+        self.config_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.config_dir.cleanup)
+        env = patch.dict(os.environ, {'CONFIG_PATH': self.config_dir.name})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def ogc_service(self, config=None, permissions=PERMISSIONS):
+        """Return OGC service for tenant config with custom config options.
+
+        :param obj config: Custom config options
+        :param obj permissions: Permissions
+        """
+        ogc_config = dict(OGC_CONFIG)
+        ogc_config['config'] = dict(OGC_CONFIG['config'], **(config or {}))
+
+        tenant_dir = os.path.join(self.config_dir.name, 'default')
+        os.makedirs(tenant_dir, exist_ok=True)
+        with open(os.path.join(tenant_dir, 'ogcConfig.json'), 'w') as fh:
+            json.dump(ogc_config, fh)
+        with open(os.path.join(tenant_dir, 'permissions.json'), 'w') as fh:
+            json.dump(permissions, fh)
+
+        return OGCService('default', logging.getLogger('ogc_service_tests'))
+
+    def upstream_server(self):
+        """Start local HTTP server which sets a cookie and records the
+        headers of each request. Return its URL and the recorded headers.
+        """
+        received_headers = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                received_headers.append(self.headers)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Set-Cookie', 'lb=node1; Path=/')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        url = 'http://127.0.0.1:%d/ows/' % server.server_port
+        return url, received_headers
+
+    def test_session_does_not_store_cookies(self):
+        url, received_headers = self.upstream_server()
+        ogc_service = self.ogc_service({'default_qgis_server_url': url})
+
+        for i in range(2):
+            response = ogc_service.session.get(url)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('node1', response.cookies.get('lb'))
+
+        # upstream cookie is not sent with subsequent requests
+        self.assertEqual(
+            [None, None],
+            [headers.get('Cookie') for headers in received_headers]
+        )
+        self.assertEqual(0, len(ogc_service.session.cookies))
+
+    def test_session_pool_per_upstream_host(self):
+        ogc_service = self.ogc_service()
+        self.assertEqual(
+            {
+                ('http', 'localhost:8001'),
+                ('http', 'print.example.com')
+            },
+            ogc_service.upstream_hosts()
+        )
+        adapter = ogc_service.session.get_adapter('http://localhost:8001/')
+        self.assertEqual(2, adapter._pool_connections)
+
+    def test_accept_encoding_for_compressed_formats(self):
+        url, received_headers = self.upstream_server()
+        ogc_service = self.ogc_service()
+        permission = {'ogc_url': url, 'print_url': url}
+
+        # (<REQUEST>, <FORMAT>, <without content encoding>)
+        cases = [
+            ('GETMAP', 'image/png', True),
+            ('GETMAP', 'image/png; mode=8bit', True),
+            ('GETMAP', 'image/jpeg', True),
+            ('GETMAP', 'application/dxf', False),
+            ('GETMAP', 'image/svg+xml', False),
+            ('GETMAP', None, False),
+            ('GETLEGENDGRAPHIC', 'image/png', True),
+            ('GETLEGENDGRAPHIC', 'application/json', False),
+            ('GETLEGENDGRAPHIC', 'text/html', False),
+            ('GETPRINT', 'pdf', True),
+            ('GETPRINT', 'application/pdf', True),
+            ('GETPRINT', 'svg', False)
+        ]
+        for ogc_request, format, identity in cases:
+            with self.subTest(request=ogc_request, format=format):
+                params = {'SERVICE': 'WMS', 'REQUEST': ogc_request}
+                if format is not None:
+                    params['FORMAT'] = format
+                response = ogc_service.forward_request(
+                    'GET', 'http://localhost/', params, '/ows', permission
+                )
+                self.assertEqual(200, response.status_code)
+                response.close()
+
+                self.assertEqual(
+                    identity,
+                    received_headers[-1].get('Accept-Encoding') == 'identity'
+                )
+
+    def count_collected_permissions(self, ogc_service):
+        """Return mock counting collected service permissions.
+
+        :param OGCService ogc_service: OGC service
+        """
+        collect_patch = patch.object(
+            ogc_service, 'collect_service_permissions',
+            wraps=ogc_service.collect_service_permissions
+        )
+        collect = collect_patch.start()
+        self.addCleanup(collect_patch.stop)
+        return collect
+
+    def test_permissions_cache_hit(self):
+        ogc_service = self.ogc_service()
+        collect = self.count_collected_permissions(ogc_service)
+
+        permissions = ogc_service.service_permissions(
+            'demo', 'qwc_demo', 'WMS'
+        )
+        self.assertEqual(
+            frozenset(['qwc_demo', 'countries']), permissions['public_layers']
+        )
+        self.assertIs(
+            permissions,
+            ogc_service.service_permissions('demo', 'qwc_demo', 'WMS')
+        )
+        self.assertEqual(1, collect.call_count)
+
+        # separate entries per service and OWS type
+        ogc_service.service_permissions('demo', 'qwc_demo', 'WFS')
+        ogc_service.service_permissions('demo', 'other', 'WMS')
+        self.assertEqual(3, collect.call_count)
+
+    def test_permissions_cache_expiry(self):
+        ogc_service = self.ogc_service({'permissions_cache_ttl': 60})
+        collect = self.count_collected_permissions(ogc_service)
+
+        with patch('ogc_service.time.monotonic', return_value=1000.0):
+            ogc_service.service_permissions('demo', 'qwc_demo', 'WMS')
+        with patch('ogc_service.time.monotonic', return_value=1059.0):
+            ogc_service.service_permissions('demo', 'qwc_demo', 'WMS')
+        self.assertEqual(1, collect.call_count)
+
+        with patch('ogc_service.time.monotonic', return_value=1060.0):
+            ogc_service.service_permissions('demo', 'qwc_demo', 'WMS')
+        self.assertEqual(2, collect.call_count)
+
+    def test_permissions_cache_disabled(self):
+        ogc_service = self.ogc_service({'permissions_cache_ttl': 0})
+        collect = self.count_collected_permissions(ogc_service)
+
+        ogc_service.service_permissions('demo', 'qwc_demo', 'WMS')
+        ogc_service.service_permissions('demo', 'qwc_demo', 'WMS')
+        self.assertEqual(2, collect.call_count)
+        self.assertEqual({}, ogc_service.permissions_cache)
+
+    def test_permissions_cache_size(self):
+        ogc_service = self.ogc_service({'permissions_cache_size': 2})
+        collect = self.count_collected_permissions(ogc_service)
+
+        for username in ['user1', 'user2', 'user3']:
+            ogc_service.service_permissions(username, 'qwc_demo', 'WMS')
+        self.assertEqual(2, len(ogc_service.permissions_cache))
+        self.assertEqual(3, collect.call_count)
+
+        # oldest entry has been removed
+        ogc_service.service_permissions('user3', 'qwc_demo', 'WMS')
+        self.assertEqual(3, collect.call_count)
+        ogc_service.service_permissions('user1', 'qwc_demo', 'WMS')
+        self.assertEqual(4, collect.call_count)
+        self.assertEqual(2, len(ogc_service.permissions_cache))
+
+    def test_permissions_cache_per_groups(self):
+        ogc_service = self.ogc_service()
+
+        editor = ogc_service.service_permissions(
+            {'username': 'demo', 'groups': ['editors']}, 'qwc_demo', 'WMS'
+        )
+        user = ogc_service.service_permissions(
+            {'username': 'demo', 'groups': []}, 'qwc_demo', 'WMS'
+        )
+        self.assertIn('edit_points', editor['public_layers'])
+        self.assertEqual(
+            frozenset(['id', 'name']), editor['layer_attributes']['edit_points']
+        )
+        self.assertNotIn('edit_points', user['public_layers'])
+        self.assertNotIn('edit_points', user['layer_attributes'])
+
+        # same set of groups shares an entry
+        self.assertIs(
+            editor,
+            ogc_service.service_permissions(
+                {'username': 'demo', 'groups': ['editors', 'editors']},
+                'qwc_demo', 'WMS'
+            )
+        )
+
+    def test_service_exception_xml(self):
+        self.assertEqual(
+            b'<ServiceExceptionReport version="1.3.0">\n'
+            b' <ServiceException code="InvalidFormat">'
+            b'Format not supported</ServiceException>\n'
+            b'</ServiceExceptionReport>',
+            service_exception_xml('InvalidFormat', 'Format not supported')
+        )
+
+    def test_service_exception_xml_escaping(self):
+        code = 'Code "A" & <B>'
+        message = "Format '<x>' & \"y\" not supported ]]>"
+
+        root = etree.fromstring(service_exception_xml(code, message))
+        self.assertEqual(1, len(root))
+        self.assertEqual(code, root[0].get('code'))
+        self.assertEqual(message, root[0].text)
+
+    def test_service_exception_escapes_request_params(self):
+        ogc_service = self.ogc_service()
+
+        response = ogc_service.get(
+            None, 'qwc_demo', 'http://localhost/', {
+                'SERVICE': 'WMS', 'REQUEST': 'GetFeatureInfo',
+                'QUERY_LAYERS': 'countries',
+                'INFO_FORMAT': 'application/vnd.ogc.gml/<x>&'
+            }, '/ows', None
+        )
+        self.assertEqual(200, response.status_code)
+        root = etree.fromstring(response.data)
+        self.assertEqual('InvalidFormat', root[0].get('code'))
+        self.assertIn("'application/vnd.ogc.gml/<x>&'", root[0].text)
+
+    def getmap_params(self, **params):
+        """Return GetMap request params.
+
+        :param obj params: Custom request params
+        """
+        return dict({
+            'SERVICE': 'WMS', 'REQUEST': 'GETMAP', 'LAYERS': 'countries'
+        }, **params)
+
+    def test_marker_params(self):
+        ogc_service = self.ogc_service(MARKER_CONFIG)
+        permission = ogc_service.service_permissions(None, 'qwc_demo', 'WMS')
+
+        params = self.getmap_params(
+            MARKER='X->1.5|Y->2|FILL->00ff00|LABEL->a->b',
+            HIGHLIGHT_GEOM='POINT (0 0)'
+        )
+        method = ogc_service.adjust_params(params, permission, None, 'GET')
+        self.assertEqual('POST', method)
+        self.assertEqual(
+            'POINT (0 0);POINT (1.5 2)', params['HIGHLIGHT_GEOM']
+        )
+        # values may contain '->'
+        self.assertEqual(
+            '<Fill>#00ff00</Fill><Label>a->b</Label>',
+            params['HIGHLIGHT_SYMBOL']
+        )
+
+        # default values
+        params = self.getmap_params(MARKER='X->1|Y->2')
+        ogc_service.adjust_params(params, permission, None, 'GET')
+        self.assertEqual(
+            '<Fill>#FFFFFF</Fill><Label>x</Label>', params['HIGHLIGHT_SYMBOL']
+        )
+
+    def test_marker_params_bad_request(self):
+        ogc_service = self.ogc_service(MARKER_CONFIG)
+        permission = ogc_service.service_permissions(None, 'qwc_demo', 'WMS')
+
+        for marker in [
+            # entry without '->'
+            'X->1|Y->2|FILL',
+            'X->1|Y',
+            # missing Y
+            'X->1',
+            # bad values
+            'X->a|Y->2',
+            'X->1|Y->2|FILL->zz',
+            # unknown param
+            'X->1|Y->2|FOO->bar'
+        ]:
+            with self.subTest(marker=marker):
+                with self.assertRaises(BadRequest) as cm:
+                    ogc_service.adjust_params(
+                        self.getmap_params(MARKER=marker), permission, None,
+                        'GET'
+                    )
+                self.assertEqual(400, cm.exception.code)
+
+    def test_getmap_layers_cache(self):
+        ogc_service = self.ogc_service()
+        editor = {'username': 'demo', 'groups': ['editors']}
+        permission = ogc_service.service_permissions(
+            editor, 'qwc_demo', 'WMS'
+        )
+        expand = patch.object(
+            ogc_service, 'expand_group_layers_opacities_styles',
+            wraps=ogc_service.expand_group_layers_opacities_styles
+        )
+        expand_mock = expand.start()
+        self.addCleanup(expand.stop)
+
+        for i in range(2):
+            params = self.getmap_params(
+                LAYERS='countries,edit_demo', OPACITIES='255,128',
+                STYLES='default,'
+            )
+            ogc_service.adjust_params(params, permission, None, 'GET')
+            # group layer is expanded to sublayers ordered from bottom to top
+            self.assertEqual(
+                'countries,edit_lines,edit_points', params['LAYERS']
+            )
+            self.assertEqual('255,128,128', params['OPACITIES'])
+            self.assertEqual('default,,', params['STYLES'])
+        self.assertEqual(1, expand_mock.call_count)
+
+        # separate entries for other opacities or styles
+        params = self.getmap_params(
+            LAYERS='countries,edit_demo', OPACITIES='255,64'
+        )
+        ogc_service.adjust_params(params, permission, None, 'GET')
+        self.assertEqual('255,64,64', params['OPACITIES'])
+        self.assertEqual(2, expand_mock.call_count)
+        self.assertEqual(2, len(permission['getmap_layers_cache']))
+
+        # separate caches per identity
+        public_permission = ogc_service.service_permissions(
+            None, 'qwc_demo', 'WMS'
+        )
+        self.assertEqual({}, public_permission['getmap_layers_cache'])
+        params = self.getmap_params(LAYERS='edit_demo')
+        ogc_service.adjust_params(params, public_permission, None, 'GET')
+        # group layer is not expanded without permission
+        self.assertEqual('edit_demo', params['LAYERS'])
+        self.assertEqual(1, len(public_permission['getmap_layers_cache']))
+        self.assertEqual(2, len(permission['getmap_layers_cache']))
+
+    def test_getmap_layers_cache_size(self):
+        ogc_service = self.ogc_service()
+        permission = ogc_service.service_permissions(None, 'qwc_demo', 'WMS')
+
+        with patch('ogc_service.GETMAP_LAYERS_CACHE_SIZE', 2):
+            for layers in ['countries', 'edit_points', 'countries,edit_points']:
+                params = self.getmap_params(LAYERS=layers)
+                ogc_service.adjust_params(params, permission, None, 'GET')
+                self.assertEqual(layers, params['LAYERS'])
+                self.assertLessEqual(
+                    len(permission['getmap_layers_cache']), 2
+                )
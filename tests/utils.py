@@ -0,0 +1,22 @@
+import io
+
+import requests
+import urllib3
+
+
+def upstream_response(body, content_type='text/xml; charset=utf-8',
+                      status=200):
+    """Return a QGIS server response with a raw stream of body.
+
+    :param bytes body: Response body
+    :param str content_type: Content type
+    :param int status: Status code
+    """
+    response = requests.Response()
+    response.status_code = status
+    response.headers['content-type'] = content_type
+    response.raw = urllib3.HTTPResponse(
+        body=io.BytesIO(body), headers={'content-type': content_type},
+        status=status, preload_content=False
+    )
+    return response
@@ -0,0 +1,101 @@
+import unittest
+
+from lxml import etree
+
+from tests.utils import upstream_response
+from wfs_response_filters import wfs_getcapabilities, wfs_getfeature
+
+
+class WfsResponseFiltersTestCase(unittest.TestCase):
+    """Test case for WFS response filters"""
+
+    def test_getcapabilities_filter_layers(self):
+        body = (
+            b'<WFS_Capabilities xmlns="http://www.opengis.net/wfs">'
+            b'<Capability><Request><GetFeature/><Transaction/></Request>'
+            b'</Capability>'
+            b'<FeatureTypeList>'
+            b'<FeatureType><Name>public</Name></FeatureType>'
+            b'<FeatureType><Name>secret</Name></FeatureType>'
+            b'</FeatureTypeList>'
+            b'</WFS_Capabilities>'
+        )
+        permissions = {'public_layers': frozenset(['public'])}
+
+        response = wfs_getcapabilities(
+            upstream_response(body), {}, permissions
+        )
+        self.assertEqual(200, response.status_code)
+        root = etree.fromstring(response.data)
+        ns = {'ns': 'http://www.opengis.net/wfs'}
+        self.assertEqual(
+            ['public'], root.xpath('//ns:FeatureType/ns:Name/text()',
+                                   namespaces=ns)
+        )
+        self.assertEqual([], root.xpath('//ns:Transaction', namespaces=ns))
+
+    def test_getcapabilities_without_feature_type_list(self):
+        # e.g. ServiceExceptionReport returned with status 200
+        body = (
+            b'<ServiceExceptionReport version="1.2.0" '
+            b'xmlns="http://www.opengis.net/ogc">'
+            b'<ServiceException code="ProjectNotFound">'
+            b'Project file error</ServiceException>'
+            b'</ServiceExceptionReport>'
+        )
+
+        response = wfs_getcapabilities(
+            upstream_response(body), {}, {'public_layers': frozenset()}
+        )
+        self.assertEqual(200, response.status_code)
+        root = etree.fromstring(response.data)
+        self.assertEqual(
+            '{http://www.opengis.net/ogc}ServiceExceptionReport', root.tag
+        )
+        self.assertEqual('Project file error', root[0].text)
+        self.assertEqual('ProjectNotFound', root[0].get('code'))
+
+    def test_getfeature_filter_attributes(self):
+        body = (
+            b'<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs" '
+            b'xmlns:gml="http://www.opengis.net/gml" '
+            b'xmlns:qgs="http://www.qgis.org/gml">'
+            b'<gml:featureMember><qgs:points fid="points.1">'
+            b'<qgs:name>a</qgs:name><qgs:secret>b</qgs:secret>'
+            b'</qgs:points></gml:featureMember>'
+            b'</wfs:FeatureCollection>'
+        )
+        permissions = {'layer_attributes': {'points': frozenset(['name'])}}
+
+        response = wfs_getfeature(upstream_response(body), {}, permissions)
+        self.assertEqual(200, response.status_code)
+        root = etree.fromstring(response.data)
+        ns = {'qgs': 'http://www.qgis.org/gml'}
+        self.assertEqual(['a'], root.xpath('//qgs:name/text()', namespaces=ns))
+        self.assertEqual([], root.xpath('//qgs:secret', namespaces=ns))
+
+    def test_getfeature_huge_geometry(self):
+        # text node larger than the default libxml2 limit of 10 MB
+        coordinates = b' '.join([b'2600000.123,1200000.456'] * 700000)
+        body = (
+            b'<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs" '
+            b'xmlns:gml="http://www.opengis.net/gml" '
+            b'xmlns:qgs="http://www.qgis.org/gml">'
+            b'<gml:featureMember><qgs:lines fid="lines.1">'
+            b'<qgs:geometry><gml:LineString><gml:coordinates>' +
+            coordinates +
+            b'</gml:coordinates></gml:LineString></qgs:geometry>'
+            b'</qgs:lines></gml:featureMember>'
+            b'</wfs:FeatureCollection>'
+        )
+        self.assertGreater(len(coordinates), 10 * 1024 * 1024)
+        permissions = {'layer_attributes': {'lines': frozenset(['geometry'])}}
+
+        response = wfs_getfeature(upstream_response(body), {}, permissions)
+        self.assertEqual(200, response.status_code)
+        root = etree.fromstring(response.data, etree.XMLParser(huge_tree=True))
+        ns = {'gml': 'http://www.opengis.net/gml'}
+        self.assertEqual(
+            coordinates.decode(),
+            root.xpath('//gml:coordinates/text()', namespaces=ns)[0]
+        )
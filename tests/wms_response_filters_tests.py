@@ -0,0 +1,245 @@
+import unittest
+
+from lxml import etree
+
+from tests.utils import upstream_response
+from wms_response_filters import update_online_resources, \
+    wms_getcapabilities, wms_getfeatureinfo
+
+
+WMS_NS = {'ns': 'http://www.opengis.net/wms'}
+
+
+def capabilities(layers, abstract=b''):
+    """Return WMS 1.3.0 GetProjectSettings XML with layers below root layer.
+
+    :param bytes layers: Layers XML
+    :param bytes abstract: Service abstract
+    """
+    return (
+        b'<WMS_Capabilities version="1.3.0" '
+        b'xmlns="http://www.opengis.net/wms" '
+        b'xmlns:xlink="http://www.w3.org/1999/xlink">'
+        b'<Service><Name>WMS</Name><Abstract>' + abstract + b'</Abstract>'
+        b'<OnlineResource xlink:href="http://qgis/ows/demo"/></Service>'
+        b'<Capability><Layer><Name>demo</Name>' + layers + b'</Layer>'
+        b'</Capability>'
+        b'</WMS_Capabilities>'
+    )
+
+
+def layer(name, children=b'', attributes=()):
+    """Return WMS layer XML.
+
+    :param str name: Layer name
+    :param bytes children: Sublayers XML
+    :param list(str) attributes: Attribute names
+    """
+    xml = b'<Layer queryable="1"><Name>' + name.encode() + b'</Name>'
+    if attributes:
+        xml += b'<Attributes>' + b''.join(
+            b'<Attribute name="%s"/>' % attr.encode() for attr in attributes
+        ) + b'</Attributes>'
+    return xml + children + b'</Layer>'
+
+
+class WmsResponseFiltersTestCase(unittest.TestCase):
+    """Test case for WMS response filters"""
+
+    def permissions(self, public_layers, queryable_layers=(),
+                    layer_attributes=None):
+        return {
+            'service_name': 'demo',
+            'online_resources': {
+                'service': 'http://example.com/ows/demo'
+            },
+            'public_layers': frozenset(public_layers),
+            'queryable_layers': frozenset(queryable_layers),
+            'layer_attributes': layer_attributes or {},
+            'print_templates': frozenset()
+        }
+
+    def getcapabilities(self, body, permissions):
+        response = wms_getcapabilities(
+            upstream_response(body), 'http://example.com/', {}, '/ows',
+            permissions
+        )
+        self.assertEqual(200, response.status_code)
+        return etree.fromstring(response.data)
+
+    def test_getcapabilities_filter_layers(self):
+        body = capabilities(
+            layer('group', layer('a') + layer('secret_a')) +
+            layer('secret_group', layer('b')) +
+            layer('c', attributes=['id', 'name', 'secret'])
+        )
+        permissions = self.permissions(
+            ['demo', 'group', 'a', 'b', 'c'], ['a'],
+            {'c': frozenset(['id', 'name'])}
+        )
+
+        root = self.getcapabilities(body, permissions)
+        self.assertEqual(
+            ['demo', 'group', 'a', 'c'],
+            root.xpath('//ns:Layer/ns:Name/text()', namespaces=WMS_NS)
+        )
+        # sublayers of removed group are removed as well
+        self.assertEqual(
+            [], root.xpath('//ns:Name[text()="b"]', namespaces=WMS_NS)
+        )
+        self.assertEqual(
+            ['1'], root.xpath(
+                '//ns:Layer[ns:Name="a"]/@queryable', namespaces=WMS_NS
+            )
+        )
+        self.assertEqual(
+            ['0'], root.xpath(
+                '//ns:Layer[ns:Name="c"]/@queryable', namespaces=WMS_NS
+            )
+        )
+        self.assertEqual(
+            ['id', 'name'], root.xpath(
+                '//ns:Layer[ns:Name="c"]/ns:Attributes/ns:Attribute/@name',
+                namespaces=WMS_NS
+            )
+        )
+        self.assertEqual(
+            ['http://example.com/ows/demo'], root.xpath(
+                '//ns:Service/ns:OnlineResource/@xlink:href',
+                namespaces=dict(WMS_NS, xlink='http://www.w3.org/1999/xlink')
+            )
+        )
+
+    def test_update_online_resources(self):
+        xlink_href = '{http://www.w3.org/1999/xlink}href'
+        elements = [
+            etree.Element('OnlineResource', {xlink_href: href})
+            for href in [
+                'http://qgis/ows/demo;v=1?MAP=/data/demo.qgs&SERVICE=WMS',
+                'http://qgis/ows/demo;v=1?MAP=/data/demo.qgs&SERVICE=WMS',
+                'ftp://qgis/demo'
+            ]
+        ]
+
+        update_online_resources(
+            elements, '/ows/demo', 'http://www.w3.org/1999/xlink',
+            'http://example.com/'
+        )
+        self.assertEqual(
+            [
+                'http://example.com/ows/demo;v=1?SERVICE=WMS',
+                'http://example.com/ows/demo;v=1?SERVICE=WMS',
+                'ftp://qgis/demo'
+            ],
+            [element.get(xlink_href) for element in elements]
+        )
+
+    def test_getcapabilities_huge_text(self):
+        # text node larger than the default libxml2 limit of 10 MB
+        abstract = b'x' * (11 * 1024 * 1024)
+        body = capabilities(layer('a'), abstract)
+
+        root = etree.fromstring(
+            wms_getcapabilities(
+                upstream_response(body), 'http://example.com/', {}, '/ows',
+                self.permissions(['demo', 'a'])
+            ).data,
+            etree.XMLParser(huge_tree=True)
+        )
+        self.assertEqual(
+            len(abstract), len(root.find('ns:Service/ns:Abstract', WMS_NS).text)
+        )
+        self.assertEqual(
+            ['demo', 'a'],
+            root.xpath('//ns:Layer/ns:Name/text()', namespaces=WMS_NS)
+        )
+
+    def getfeatureinfo(self, body, info_format, permissions):
+        response = wms_getfeatureinfo(
+            upstream_response(body, info_format + '; charset=utf-8'),
+            {'INFO_FORMAT': info_format}, permissions
+        )
+        self.assertEqual(200, response.status_code)
+        return etree.fromstring(
+            response.data, etree.XMLParser(huge_tree=True)
+        )
+
+    def test_getfeatureinfo_xml_filter_attributes(self):
+        body = (
+            b'<GetFeatureInfoResponse>'
+            b'<Layer name="Points Alias"><Feature id="1">'
+            b'<Attribute name="name" value="a"/>'
+            b'<Attribute name="secret" value="b"/>'
+            b'</Feature></Layer>'
+            b'<Layer name="lines"><Feature id="2">'
+            b'<Attribute name="name" value="c"/>'
+            b'</Feature></Layer>'
+            b'</GetFeatureInfoResponse>'
+        )
+        permissions = {
+            'feature_info_aliases': {'Points Alias': 'points'},
+            'layer_attributes': {'points': frozenset(['name'])}
+        }
+
+        root = self.getfeatureinfo(body, 'text/xml', permissions)
+        self.assertEqual(
+            ['name'],
+            root.xpath('//Layer[@name="Points Alias"]//Attribute/@name')
+        )
+        # no permitted attributes for layer without permissions
+        self.assertEqual([], root.xpath('//Layer[@name="lines"]//Attribute'))
+
+    def test_getfeatureinfo_gml_filter_attributes(self):
+        body = (
+            b'<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs" '
+            b'xmlns:gml="http://www.opengis.net/gml" '
+            b'xmlns:qgs="http://qgis.org/gml">'
+            b'<gml:featureMember><qgs:points fid="points.1">'
+            b'<qgs:name>a</qgs:name><qgs:secret>b</qgs:secret>'
+            b'</qgs:points></gml:featureMember>'
+            b'</wfs:FeatureCollection>'
+        )
+        permissions = {'layer_attributes': {'points': frozenset(['name'])}}
+
+        root = self.getfeatureinfo(
+            body, 'application/vnd.ogc.gml', permissions
+        )
+        ns = {'qgs': 'http://qgis.org/gml'}
+        self.assertEqual(['a'], root.xpath('//qgs:name/text()', namespaces=ns))
+        self.assertEqual([], root.xpath('//qgs:secret', namespaces=ns))
+
+    def test_getfeatureinfo_xml_huge_text(self):
+        # text node larger than the default libxml2 limit of 10 MB
+        geometry = 'x' * (11 * 1024 * 1024)
+        permissions = {'layer_attributes': {'points': frozenset(['geometry'])}}
+
+        body = (
+            b'<GetFeatureInfoResponse><Layer name="points"><Feature id="1">'
+            b'<Attribute name="geometry" value="' + geometry.encode() + b'"/>'
+            b'</Feature></Layer></GetFeatureInfoResponse>'
+        )
+        root = self.getfeatureinfo(body, 'text/xml', permissions)
+        self.assertEqual([geometry], root.xpath('//Attribute/@value'))
+
+    def test_getfeatureinfo_gml_huge_text(self):
+        # text node larger than the default libxml2 limit of 10 MB
+        geometry = 'x' * (11 * 1024 * 1024)
+        permissions = {'layer_attributes': {'points': frozenset(['geometry'])}}
+
+        body = (
+            b'<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs" '
+            b'xmlns:gml="http://www.opengis.net/gml" '
+            b'xmlns:qgs="http://qgis.org/gml">'
+            b'<gml:featureMember><qgs:points fid="points.1">'
+            b'<qgs:geometry>' + geometry.encode() + b'</qgs:geometry>'
+            b'</qgs:points></gml:featureMember>'
+            b'</wfs:FeatureCollection>'
+        )
+        root = self.getfeatureinfo(
+            body, 'application/vnd.ogc.gml', permissions
+        )
+        self.assertEqual(
+            [geometry], root.xpath(
+                '//qgs:geometry/text()', namespaces={'qgs': 'http://qgis.org/gml'}
+            )
+        )